@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+'''
+writes a synthetic mbox archive (the archive the build benchmarks use)
+
+    python benchmarks/archive.py COUNT [SEED] > archive.mbox
+
+Most messages reply to one of the 30 messages before them, some to messages
+missing from the archive. The senders, subjects (some encoded) and time
+zones repeat, and the bodies have escaped "From " lines.
+'''
+
+from __future__ import print_function, unicode_literals
+
+import random
+import sys
+
+
+SUBJECTS = ['Hello world', '=?utf-8?q?caf=C3=A9_time?=', 'Re: Build broken',
+            'Proposal: new site', 'Meeting']
+
+
+def archive(count, seed=1):
+    'yields the messages of the archive (as text)'
+
+    random.seed(seed)
+    ids = []
+    for i in range(count):
+        message_id = '<msg%d@example.com>' % i
+        lines = [
+            'From user%d at example.com  Mon Apr  %d 10:%02d:00 2012'
+                % (i % 7, 1 + i % 28, i % 60),
+            'From: user%d at example.com (User %d)' % (i % 7, i % 7),
+            'Date: Mon, %d Apr 2012 10:%02d:%02d %s'
+                % (1 + i % 28, i % 60, i % 60,
+                   random.choice(['-0700', '+0000', '+0530'])),
+            'Subject: %s' % random.choice(SUBJECTS),
+        ]
+
+        if ids and random.random() < 0.6:
+            parent = random.choice(ids[-30:])
+            lines.append('In-Reply-To: %s' % parent)
+            lines.append('References: <ext%d@example.com> %s'
+                             % (i % 5, parent))
+
+        elif random.random() < 0.2:
+            lines.append('In-Reply-To: <ext%d@example.com>' % (i % 5))
+            lines.append('References: <root%d@example.com> '
+                         '<ext%d@example.com>' % (i % 3, i % 5))
+
+        lines.append('Message-ID: %s' % message_id)
+        for host in range(3):
+            lines.append('Received: from host%d by mx.example.com; '
+                         'Mon, 2 Apr 2012' % host)
+
+        lines += ['', 'Body of message %d' % i, '>From the quoted line',
+                  'more text %s' % ('x' * random.randint(0, 200)), '']
+
+        ids.append(message_id)
+        yield '\n'.join(lines)
+
+
+def main(count, seed=1):
+    sys.stdout.write('\n'.join(archive(count, seed)) + '\n')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
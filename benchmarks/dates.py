@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+'''
+times ``normalize_date`` against parsing every date with dateutil (the path
+it replaced) on random RFC 2822 dates, and checks both give the same
+timestamps
+
+    TZ=UTC PYTHONPATH=. python benchmarks/dates.py [COUNT]
+
+(the dateutil path reads its UTC time tuple as local time, so it only gives
+the right timestamps in UTC)
+'''
+
+from __future__ import print_function, unicode_literals
+
+import random
+import sys
+import time
+
+from timeit import repeat
+
+from dateutil import tz
+from dateutil.parser import parse as dateparser
+
+from mailarchive.parse import DATES, normalize_date
+
+
+DAYS = 'Mon Tue Wed Thu Fri Sat Sun'.split()
+MONTHS = 'Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec'.split()
+
+# dates the fast path leaves to dateutil
+ODD_DATES = [
+    '1 Apr 2012 10:00 +0000',
+    'Mon, 01 Apr 2012 10:00:00 GMT',
+    '2012-04-01 10:00:00',
+    'Mon Apr  2 10:00:00 2012',
+    'Mon, 1 Apr 12 10:00:00 -0700',
+    'Tue, 28 Feb 2012 23:59:59 -1200',
+    'Wed, 1 apr 2012 1:2:3 +0100',
+]
+
+UTC = tz.tzutc()
+
+
+def dateutil_date(date):
+    'the timestamp of a date as computed before the fast path'
+
+    utc = dateparser(date).astimezone(UTC)
+    return int(time.mktime(utc.timetuple()))
+
+
+def random_dates(count, seed=3):
+    'returns random RFC 2822 dates (a fifth with a zone name comment)'
+
+    random.seed(seed)
+    dates = []
+    for i in range(count):
+        date = '%s, %d %s %d %02d:%02d:%02d %s%02d%02d' % (
+            random.choice(DAYS), random.randint(1, 28),
+            random.choice(MONTHS), random.randint(1995, 2012),
+            random.randint(0, 23), random.randint(0, 59),
+            random.randint(0, 59), random.choice('+-'),
+            random.randint(0, 12), random.choice([0, 30]),
+        )
+
+        if i % 5 == 0: date += ' (PDT)'
+        dates.append(date)
+
+    return dates
+
+
+def main(count=20000):
+    dates = random_dates(count)
+
+    different = [d for d in dates + ODD_DATES
+                 if dateutil_date(d) != normalize_date(d)]
+    if different:
+        sys.exit('different timestamps for: %s' % ', '.join(different))
+
+    def cold():
+        DATES.clear()
+        for date in dates: normalize_date(date)
+
+    old = min(repeat(lambda: [dateutil_date(d) for d in dates], number=1,
+                     repeat=3))
+    new = min(repeat(cold, number=1, repeat=3))
+
+    print('%d dates (best of 3), identical timestamps' % count)
+    print('  dateutil.parse + astimezone + mktime  %.2fs' % old)
+    print('  normalize_date (cold cache)           %.2fs  (%.0fx)'
+          % (new, old / new))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
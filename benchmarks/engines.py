@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+'''
+times the threading engines (see ``THREADERS``) on synthetic conversations
+of 20 messages, where a fifth of the replies have no In-Reply-To header and
+a tenth a mangled one, and on single reply chains (the worst case of the
+loop check of ``reference_threads``)
+
+    PYTHONPATH=. python benchmarks/engines.py [COUNT ...]
+
+The loop check walked every chain of ancestors before it was only run for
+messages with replies, set ``PYTHONPATH`` to a checkout from before that to
+compare the chains.
+'''
+
+from __future__ import print_function, unicode_literals
+
+import random
+import sys
+
+from timeit import default_timer
+
+from mailarchive.shared import Headers, Message
+from mailarchive.thread import THREADERS, reference_threads
+
+
+def conversations(count, size=20, seed=2):
+    '''
+    returns messages in conversations of ``size`` messages, every reply has
+    a full References header (70% a matching In-Reply-To, 10% a mangled one)
+    '''
+
+    random.seed(seed)
+    messages, chains = [], {}
+    for i in range(count):
+        first = i - i % size
+        if i == first:
+            chain = []
+        else:
+            parent = random.randrange(first, i)
+            chain = chains[parent] + ['<m%d>' % parent]
+
+        chains[i] = chain
+
+        headers = dict(message_id='<m%d>' % i, subject='s%d' % (i // size),
+                       date_utc=i)
+        if chain:
+            headers['references'] = ' '.join(chain)
+
+            choice = random.random()
+            if choice < 0.7:
+                headers['in_reply_to'] = chain[-1]
+            elif choice < 0.8:
+                headers['in_reply_to'] = '<mangled%d>' % i
+
+        messages.append(Message(headers=Headers(**headers), payload=''))
+
+    return messages
+
+
+def reply_chain(count, references=10):
+    'returns a single chain of replies (with the last ``references``)'
+
+    return [Message(headers=Headers(
+        message_id='<m%d>' % i, subject='s', date_utc=i,
+        in_reply_to='<m%d>' % (i - 1) if i else None,
+        references=' '.join('<m%d>' % j
+                            for j in range(max(0, i - references), i)),
+    ), payload='') for i in range(count)]
+
+
+def timed(threader, messages):
+    'returns the threads of the messages and the time it took'
+
+    start = default_timer()
+    threads = list(threader(messages))
+    return threads, default_timer() - start
+
+
+def main(*counts):
+    for count in counts or (1000, 10000, 100000):
+        messages = conversations(count)
+        for name in sorted(THREADERS):
+            threads, elapsed = timed(THREADERS[name], list(messages))
+            print('%-12s %8d messages %7d threads (of %d) %8.2fs'
+                  % (name, count, len(threads), (count + 19) // 20, elapsed))
+
+    for count in (2000, 4000, 8000):
+        _, elapsed = timed(reference_threads, reply_chain(count))
+        print('%-12s %8d message reply chain %15s %8.2fs'
+              % ('references', count, '', elapsed))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
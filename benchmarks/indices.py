@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+'''
+times partitioning the messages of an archive into the indices (see
+``INDICES``) and ``index_pages``, and prints a digest of the partitions
+
+    python benchmarks/archive.py 20000 > archive.mbox
+    PYTHONPATH=. python benchmarks/indices.py archive.mbox
+
+Each partitioner sorted the messages on its own before they shared a table
+of sort keys (``SortKeys``), set ``PYTHONPATH`` to a checkout from before it
+to compare (the digests must be the same).
+'''
+
+from __future__ import print_function, unicode_literals
+
+import json
+import sys
+
+from hashlib import sha1
+from timeit import repeat
+
+import mailarchive.utils
+
+from mailarchive.shared import NS, simple_from
+
+
+def digest(partitions):
+    'returns a digest of the messages of the partitions, in order'
+
+    def hashes(messages):
+        return [m['headers']['message_id_hash'] for m in messages]
+
+    return sha1(json.dumps([
+        [(g['name'], hashes(g['messages'])) for g in p['groups']]
+        if 'groups' in p else hashes(p['messages']) for p in partitions
+    ]).encode('utf-8')).hexdigest()[:12]
+
+
+def measure(threads, args):
+    'the indices action'
+
+    utils = mailarchive.utils
+    indexed = [
+        NS([('from', simple_from(m['headers']['from']))] + list(m.items()))
+        for _, messages in threads
+            for m in messages
+    ]
+
+    if hasattr(utils, 'SortKeys'):
+        def partition():
+            keys = utils.SortKeys(indexed)
+            return [i.partitioner(indexed, keys) for i in utils.INDICES]
+    else:
+        def partition():
+            return [i.partitioner(indexed) for i in utils.INDICES]
+
+    best = lambda f: min(repeat(f, number=1, repeat=7)) * 1e3
+
+    print('%d messages (best of 7), partitions %s'
+          % (len(indexed), digest(partition())))
+    print('  partitioning the indices  %6.1f ms' % best(partition))
+    print('  index_pages               %6.1f ms'
+          % best(lambda: utils.index_pages(threads, args)))
+
+
+def main(mbox):
+    mailarchive.utils.index_parser.set_defaults(action=measure)
+    sys.argv = ['mailarchive', '--list-address', 'list@example.com',
+                '--page-title', 'Archive',
+                '--page-link', 'http://example.com/', 'indices', mbox]
+
+    mailarchive.utils.run_mailarchive()
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+'''
+times ``normalize_threads`` on a synthetic archive where every message is a
+reply to an out of range message, in conversations of 50 messages (the
+worst case of merging out of range threads)
+
+    PYTHONPATH=. python benchmarks/out_of_range.py [COUNT ...]
+
+The merging was quadratic before the union find, set ``PYTHONPATH`` to a
+checkout from before it (and use small counts) to compare.
+'''
+
+from __future__ import print_function, unicode_literals
+
+import sys
+
+from timeit import default_timer
+
+from mailarchive.shared import Headers, Message
+from mailarchive.thread import build_threads, normalize_threads
+
+
+def out_of_range_messages(count, conversation=50, replies=5):
+    '''
+    returns messages replying to missing parents (``replies`` per parent),
+    the parents of a conversation share their missing root
+    '''
+
+    messages = []
+    for i in range(count):
+        root, parent = i // conversation, i // replies
+        messages.append(Message(headers=Headers(
+            message_id='<m%d>' % i, in_reply_to='<p%d>' % parent,
+            references='<r%d> <g%d> <p%d>' % (root, root, parent),
+            subject='s%d' % root, date_utc=i,
+        ), payload=''))
+
+    return messages
+
+
+def main(*counts):
+    for count in counts or (1000, 10000, 100000):
+        threads = list(build_threads(out_of_range_messages(count)))
+
+        start = default_timer()
+        normalized = list(normalize_threads(threads))
+        elapsed = default_timer() - start
+
+        print('%8d messages %7d out of range threads -> %6d threads %8.2fs'
+              % (count, len(threads), len(normalized), elapsed))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
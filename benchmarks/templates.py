@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+'''
+times rendering the message pages of an archive with the compiled templates
+and with the jsontemplate interpreter (``stream_template`` per page)
+
+    python benchmarks/archive.py 20000 > archive.mbox
+    PYTHONPATH=. python benchmarks/templates.py archive.mbox
+
+The pages are written to a temporary directory, both builds must give the
+same pages.
+'''
+
+from __future__ import print_function, unicode_literals
+
+import shutil
+import sys
+import tempfile
+
+from filecmp import dircmp
+from timeit import default_timer
+
+import mailarchive.template
+import mailarchive.utils
+
+
+def interpreted(*args, **kargs):
+    # ``compile_template`` falls back to the interpreter
+    raise mailarchive.template._Unsupported
+
+
+def render(mbox, output):
+    'builds the message pages and returns the times spent rendering them'
+
+    times = []
+    stream_template = mailarchive.utils.stream_template
+
+    def timed(*args, **kargs):
+        start = default_timer()
+        stream_template(*args, **kargs)
+        times.append(default_timer() - start)
+
+    mailarchive.utils.stream_template = timed
+    sys.argv = ['mailarchive', '--list-address', 'list@example.com',
+                '--page-title', 'Archive',
+                '--page-link', 'http://example.com/',
+                '--output', output, 'messages', '--force', mbox]
+    try:
+        mailarchive.utils.run_mailarchive()
+    finally:
+        mailarchive.utils.stream_template = stream_template
+
+    return times
+
+
+def main(mbox):
+    compiled_output = tempfile.mkdtemp()
+    interpreted_output = tempfile.mkdtemp()
+    try:
+        compiled = render(mbox, compiled_output)
+
+        CompiledTemplate = mailarchive.template.CompiledTemplate
+        mailarchive.template.CompiledTemplate = interpreted
+        try:
+            interpreter = render(mbox, interpreted_output)
+        finally:
+            mailarchive.template.CompiledTemplate = CompiledTemplate
+
+        different = dircmp(compiled_output, interpreted_output).diff_files
+        if different:
+            sys.exit('different pages: %s' % ', '.join(sorted(different)))
+    finally:
+        shutil.rmtree(compiled_output)
+        shutil.rmtree(interpreted_output)
+
+    print('%d pages, identical' % len(compiled))
+    for name, times in (('interpreted', interpreter), ('compiled', compiled)):
+        print('  %-12s %6.0f us/page' % (name, sum(times) / len(times) * 1e6))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
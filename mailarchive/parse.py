@@ -3,27 +3,349 @@
 from __future__ import unicode_literals
 
 import base64
+import binascii
+import calendar
+import json
 import mailbox
+import mmap
+import os
 import quopri
 import re
-import time
+import threading
 
-from dateutil import tz
+from datetime import datetime
 from dateutil.parser import parse as dateparser
 from hashlib import md5, sha1
-from io import DEFAULT_BUFFER_SIZE as BUFFER_SIZE
-from tempfile import NamedTemporaryFile
+from io import BytesIO
+from multiprocessing import Pool
 
-from mailarchive.shared import NS
+from mailarchive.shared import NS, Headers, Message
 
-UTC = tz.tzutc()
+FROM_LINE = b'From '
+LINESEP = b'\n'
 
+INDEX_SUFFIX = '.index'
+
+# headers kept in the simplified messages (``None`` keeps all of them), the
+# computed "date_utc", "from_hash" and "message_id_hash" are always added
+DEFAULT_HEADERS = ('cc', 'date', 'from', 'in_reply_to', 'message_id',
+                   'references', 'subject', 'to')
+
+# parallel parsing splits the file into at least ``SHARDS_PER_JOB`` pieces
+# per process (to balance the work), but no larger than ``SHARD_SIZE`` bytes
+SHARDS_PER_JOB = 4
+SHARD_SIZE = 16 * 1024 * 1024
+
+
+# cache of simplified header names (see ``header_name``)
+HEADER_NAMES = {}
+
+# cache of normalized dates (see ``normalize_date``), cleared when full
+DATES = {}
+DATES_SIZE = 16 * 1024
+
+# well formed RFC 2822 dates, anything else is parsed by dateutil
+DATE_PATTERN = re.compile(r'^\s*(?:[a-z]{3},\s*)?(\d{1,2})\s+([a-z]{3})\s+'
+                          r'(\d{4})\s+(\d{2}):(\d{2})(?::(\d{2}))?\s+'
+                          r'([+-])(\d{2})(\d{2})\s*(?:\([^()]*\)\s*)?$', re.I)
+
+MONTHS = dict((month, index + 1) for index, month in enumerate((
+    'jan', 'feb', 'mar', 'apr', 'may', 'jun',
+    'jul', 'aug', 'sep', 'oct', 'nov', 'dec',
+)))
 
 # encoded URL match from email.header is too strict
 # (allow non-hex characters after an '=' sign)
 ENCODED_PATTERN = re.compile(r'=\?([^?]*)\?([qb])\?(.*?)\?=([^0-9a-f]|$)',
                              re.I)
 
+
+class Deduplicator(object):
+    '''
+    drops messages whose ``message_id_hash`` was already seen and counts them
+
+    Inputs read concurrently ``claim`` the hashes instead of adding them, so
+    the messages kept do not depend on the order the inputs are read in.
+    '''
+
+    def __init__(self):
+        self.claims = {}
+        self.dropped = 0
+        self.seen = set()
+        self.__lock = threading.Lock()
+
+    def __getstate__(self):
+        # locks cannot be pickled (the options are sent to build processes)
+        state = dict(self.__dict__)
+        del state['_Deduplicator__lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__lock = threading.Lock()
+
+    def add(self, message_id_hash):
+        'returns if the hash was new (and remembers it) or counts a duplicate'
+
+        digest = binascii.unhexlify(message_id_hash)
+        with self.__lock:
+            if digest in self.seen:
+                self.dropped += 1
+                return False
+
+            self.seen.add(digest)
+            return True
+
+    def claim(self, message_id_hash, position):
+        '''
+        returns if a message of the input at ``position`` is kept, it is
+        dropped (and counted) when the hash was seen or claimed by this input
+        or an earlier one
+
+        Messages claimed by a later input first are kept as well, the later
+        copies are only dropped when the messages are added in order.
+        '''
+
+        digest = binascii.unhexlify(message_id_hash)
+        with self.__lock:
+            claimed = self.claims.get(digest)
+            if digest in self.seen or \
+               (claimed is not None and claimed <= position):
+
+                self.dropped += 1
+                return False
+
+            self.claims[digest] = position
+            return True
+
+    def remember(self, message_id_hash):
+        'remembers the hash of a message kept from a previous run'
+
+        with self.__lock:
+            self.seen.add(binascii.unhexlify(message_id_hash))
+
+
+class LazyHeaders(NS):
+    '''
+    the headers of a message keyed by their simplified name which are only
+    fetched and decoded when they are accessed
+    '''
+
+    def __init__(self, message):
+        super(LazyHeaders, self).__init__()
+        object.__setattr__(self, 'message', message)
+
+        # last header wins (like the ``dict`` this replaces)
+        object.__setattr__(self, 'names', dict(
+            (header_name(name), name) for name in message.keys()
+        ))
+
+    def __contains__(self, key):
+        return key in self.names
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __missing__(self, key):
+        value = self.message.get_all(self.names[key])[-1]
+        value = self[key] = decode(value)
+        return value
+
+    def get(self, key, default=None):
+        return self[key] if key in self.names else default
+
+    def keys(self):
+        return list(self.names)
+
+    def persist(self, names=DEFAULT_HEADERS):
+        'returns the decoded headers in ``names`` (or all if ``None``)'
+
+        if names is None:
+            names = self.names
+
+        result = Headers()
+        for name in names:
+            if name in self.names: result[name] = self[name]
+
+        return result
+
+
+class MboxIndex(object):
+    '''
+    byte offsets of the messages in a mbox file (keyed by their
+    ``message_id_hash``) so single messages can be loaded on demand
+
+    Messages without a Message-Id cannot be keyed, they are counted in
+    ``skipped`` (for the scripts to report them).
+    '''
+
+    def __init__(self, filename, entries=(), size=0, mtime=0, skipped=0):
+        self.filename = filename
+        self.size = size
+        self.mtime = mtime
+        self.skipped = skipped
+
+        # keep the file order for iteration, but allow lookups by hash
+        self.entries = [tuple(entry) for entry in entries]
+        self.by_hash = dict((h, (o, l)) for h, o, l in self.entries)
+
+    def __contains__(self, message_id_hash):
+        return message_id_hash in self.by_hash
+
+    def __iter__(self):
+        return (message_id_hash for message_id_hash, _, _ in self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def build(cls, filename):
+        'scans the mbox file once (via ``mmap``) and returns its index'
+
+        entries = []
+        skipped = 0
+        with open(filename, 'rb') as file:
+            stat = os.fstat(file.fileno())
+
+            # empty files cannot be mapped
+            if stat.st_size:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for offset, length in mbox_offsets(data):
+                        headers = read_message(message_headers(data, offset,
+                                                               length))
+
+                        # the last header wins (like ``simplify_message``)
+                        message_ids = headers.get_all('Message-Id')
+                        if not message_ids:
+                            skipped += 1
+                            continue
+
+                        message_id = decode(message_ids[-1])
+                        entries.append((hash_message_id(message_id),
+                                        offset, length))
+                finally:
+                    data.close()
+
+        return cls(filename, entries, size=stat.st_size,
+                   mtime=int(stat.st_mtime), skipped=skipped)
+
+    @classmethod
+    def load(cls, filename, index_filename=None):
+        '''
+        loads the sidecar index of a mbox file (rebuilding and saving it if it
+        is missing or the mbox file has changed)
+        '''
+
+        if index_filename is None:
+            index_filename = filename + INDEX_SUFFIX
+
+        stat = os.stat(filename)
+        try:
+            with open(index_filename, 'rb') as file:
+                data = json.loads(file.read().decode('utf-8'))
+        except (IOError, ValueError):
+            data = None
+
+        if data and (data['size'], data['mtime']) == \
+                    (stat.st_size, int(stat.st_mtime)):
+
+            return cls(filename, data['messages'], size=data['size'],
+                       mtime=data['mtime'], skipped=data.get('skipped', 0))
+
+        index = cls.build(filename)
+        index.save(index_filename)
+        return index
+
+    def save(self, index_filename=None):
+        'writes the index next to the mbox file'
+
+        if index_filename is None:
+            index_filename = self.filename + INDEX_SUFFIX
+
+        with open(index_filename, 'wb') as file:
+            file.write(json.dumps(dict(
+                size=self.size,
+                mtime=self.mtime,
+                messages=self.entries,
+                skipped=self.skipped,
+            )).encode('utf-8'))
+
+    def read(self, message_id_hash):
+        'returns the raw bytes of a message (without its "From " line)'
+
+        offset, length = self.by_hash[message_id_hash]
+        with open(self.filename, 'rb') as file:
+            file.seek(offset)
+            file.readline()
+
+            return file.read(offset + length - file.tell())
+
+    def headers(self, message_id_hash):
+        'returns the simplified headers of a message (the body is not read)'
+
+        offset, length = self.by_hash[message_id_hash]
+        with open(self.filename, 'rb') as file:
+            file.seek(offset)
+            file.readline()
+
+            lines = []
+            while file.tell() < offset + length:
+                line = file.readline()
+                if line == LINESEP: break
+
+                lines.append(line)
+
+        return simplify_message(read_message(b''.join(lines))).headers
+
+    def message(self, message_id_hash):
+        'returns a simplified message'
+
+        return simplify_message(read_message(self.read(message_id_hash)))
+
+    def messages(self, headers=DEFAULT_HEADERS, dedupe=None):
+        '''
+        yields the simplified messages in file order without their payload
+        (``None`` is used as a placeholder, see ``load_payload``)
+        '''
+
+        if not self.entries: return
+
+        with open(self.filename, 'rb') as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for message_id_hash, offset, length in self.entries:
+                    if dedupe is not None and not dedupe.add(message_id_hash):
+                        continue
+
+                    message = read_message(message_headers(data, offset,
+                                                           length))
+
+                    result = simplify_message(message, headers=headers)
+                    result.payload = None
+
+                    yield result
+            finally:
+                data.close()
+
+    def load_payload(self, message):
+        'returns the message with its payload loaded (if it was deferred)'
+
+        if message.get('payload') is not None:
+            return message
+
+        message_id_hash = message.headers.message_id_hash
+        return Message(message, payload=self.payload(message_id_hash))
+
+    def payload(self, message_id_hash):
+        'returns the payload of a message'
+
+        return read_message(self.read(message_id_hash)).get_payload()
+
+
 def _decode(match):
     'transforms a encoded match to its decoded substitution'
 
@@ -39,49 +361,286 @@ def _decode(match):
                      .decode(encoding) + trailing
 
 
+def _parse_shard(shard):
+    'parses the messages in a byte range of a mbox file (see ``mbox_shards``)'
+
+    filename, start, stop, headers = shard
+    with open(filename, 'rb') as file:
+        file.seek(start)
+        data = BytesIO(file.read(stop - start))
+
+    return [simplify_message(message, headers=headers)
+            for message in split_mbox(data)]
+
+
 def decode(string):
     'returns a properly decoded email header'
 
     return ENCODED_PATTERN.sub(_decode, string)
 
 
-def parse_mbox(filename=None, fileobj=None):
-    'parse a mbox file'
+def duplicate(message, dedupe, position=None):
+    '''
+    returns if a message instance is a duplicate according to a
+    ``Deduplicator`` (given the ``position`` of its input when inputs are
+    read concurrently, see ``Deduplicator.claim``)
+    '''
+
+    message_ids = message.get_all('Message-Id')
+    if not message_ids:
+        return False
+
+    message_id_hash = hash_message_id(decode(message_ids[-1]))
+    if position is not None:
+        return not dedupe.claim(message_id_hash, position)
+
+    return not dedupe.add(message_id_hash)
+
+
+def header_name(name):
+    'returns the simplified name of a header (e.g. "Message-Id" -> message_id)'
+
+    try:
+        return HEADER_NAMES[name]
+    except KeyError:
+        result = HEADER_NAMES[name] = name.replace('-', '_').lower()
+        return result
+
+
+def hash_message_id(message_id):
+    'returns the hash used to identify a message (and its file name)'
+
+    return sha1(message_id.encode('utf-8')).hexdigest()
+
+
+def mbox_offsets(data):
+    '''
+    yields the ``(offset, length)`` of each message in a mbox buffer
+    (the offset points to the "From " line)
+    '''
+
+    separator = LINESEP + FROM_LINE
+
+    start = data.find(separator)
+    if data[:len(FROM_LINE)] == FROM_LINE:
+        start = 0
+    elif start != -1:
+        start += 1
+
+    while start != -1:
+        following = data.find(separator, start)
+        if following == -1:
+            stop = len(data)
+        else:
+            stop = following = following + 1
+
+        # the blank line before the next "From " line is not part of the
+        # message (this matches mailbox.mbox)
+        if data[stop - 2:stop] == LINESEP * 2:
+            stop -= 1
+
+        yield start, stop - start
+        start = following
+
+
+def mbox_shards(filename, count, start=0, stop=None):
+    '''
+    returns ``(filename, start, stop)`` byte ranges which split a mbox file
+    (or the part from ``start`` to ``stop``) in about ``count`` pieces, each
+    starting on a "From " line
+    '''
+
+    with open(filename, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if stop is None or stop > size: stop = size
+        if start >= stop: return []
+
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            starts = [start]
+            for shard in range(1, count):
+                # the next "From " line at or after the shard's even split
+                split = start + (stop - start) * shard // count
+                found = data.find(LINESEP + FROM_LINE,
+                                  max(split - 1, starts[-1]), stop)
+
+                if found == -1: break
+                starts.append(found + 1)
+        finally:
+            data.close()
+
+    return [(filename, begin, end)
+            for begin, end in zip(starts, starts[1:] + [stop])]
+
+
+def message_headers(data, offset, length):
+    'returns the raw header block of the message at ``offset``'
+
+    start = data.find(LINESEP, offset, offset + length) + 1
+    stop = data.find(LINESEP * 2, start, offset + length)
+
+    return data[start:offset + length if stop == -1 else stop + 1]
+
+
+def normalize_date(date):
+    '''
+    returns the UTC timestamp of a date header (dates without a timezone are
+    assumed to be UTC)
+    '''
+
+    try:
+        return DATES[date]
+    except KeyError:
+        pass
+
+    result = None
+    match = DATE_PATTERN.match(date)
+    if match and match.group(2).lower() in MONTHS:
+        day, month, year, hour, minute, second, sign, tz_hour, tz_minute = \
+            match.groups()
+
+        try:
+            # validates the fields (e.g. Feb 30 or hour 24)
+            local = datetime(int(year), MONTHS[month.lower()], int(day),
+                             int(hour), int(minute), int(second or 0))
+        except ValueError:
+            pass
+        else:
+            offset = int(tz_hour) * 3600 + int(tz_minute) * 60
+            result = calendar.timegm(local.timetuple()) - \
+                     (offset if sign == '+' else -offset)
+
+    # malformed or obsolete dates
+    if result is None:
+        parsed = dateparser(date)
+        if parsed.tzinfo is None:
+            result = calendar.timegm(parsed.timetuple())
+        else:
+            result = calendar.timegm(parsed.utctimetuple())
+
+    if len(DATES) >= DATES_SIZE: DATES.clear()
+    DATES[date] = result
+
+    return result
+
+
+def parse_mbox(filename=None, fileobj=None, jobs=1, headers=DEFAULT_HEADERS,
+               offset=0, stop=None, dedupe=None, position=None):
+    '''
+    parse a mbox file (files specified by name can be parsed by ``jobs``
+    processes, the messages are still returned in order)
+
+    Only the ``headers`` are kept in the simplified messages (see
+    ``simplify_message``). Files specified by name can be parsed from the
+    byte ``offset`` (which must be the start of a "From " line) up to
+    ``stop``. Duplicates found by a ``Deduplicator`` are skipped before they
+    are simplified (see ``duplicate`` for the input ``position``).
+    '''
 
     if not filename and not fileobj:
         raise ValueError('one of "filename" or "fileobj" is required')
 
+    if filename and jobs > 1:
+        if stop is None: stop = os.path.getsize(filename)
+        count = max(jobs * SHARDS_PER_JOB, (stop - offset) // SHARD_SIZE + 1)
+
+        pool = Pool(jobs)
+        try:
+            shards = [shard + (headers,) for shard in
+                      mbox_shards(filename, count, start=offset, stop=stop)]
+
+            for messages in pool.imap(_parse_shard, shards):
+                for message in messages:
+                    # the processes do not share the hashes
+                    hash = message.headers.get('message_id_hash')
+                    if dedupe is not None and hash and \
+                       not (dedupe.add(hash) if position is None else
+                            dedupe.claim(hash, position)):
+
+                        continue
+
+                    yield message
+        finally:
+            pool.terminate()
+
+        return
+
     if filename:
-        mbox = mailbox.mbox(filename)
-        for message in mbox:
-            yield simplify_message(message)
+        fileobj = open(filename, 'rb')
+        fileobj.seek(offset)
 
-    else:
-        # create a tempfile because mbox needs a path
-        with NamedTemporaryFile() as tempfile:
-            for chunk in iter(lambda: fileobj.read(BUFFER_SIZE), bytes()):
-                tempfile.write(chunk)
+    try:
+        lines = fileobj if stop is None else read_lines(fileobj, stop)
+        for message in split_mbox(lines):
+            # skip corrupted messages (unless the file was specified by name)
+            if not filename and not message.get('Message-Id'): continue
+
+            if dedupe is not None and \
+               duplicate(message, dedupe, position=position):
+
+                continue
+
+            yield simplify_message(message, headers=headers)
+    finally:
+        if filename: fileobj.close()
+
+
+def prefix_checksums(filename, lengths):
+    '''
+    returns the checksums of the first ``lengths`` bytes of a file (reading
+    the file once)
+    '''
 
-            # make sure there is something to read
-            tempfile.flush()
+    checksum = sha1()
+    result = []
+    with open(filename, 'rb') as file:
+        position = 0
+        for length in sorted(set(lengths)):
+            while position < length:
+                chunk = file.read(min(length - position, SHARD_SIZE))
+                if not chunk: break
 
-            mbox = mailbox.mbox(tempfile.name)
-            for message in mbox:
-                # skip corrupted messages
-                if not message.get('Message-Id'): continue
+                checksum.update(chunk)
+                position += len(chunk)
 
-                yield simplify_message(message)
+            result.append((length, checksum.hexdigest()))
 
+    result = dict(result)
+    return [result[length] for length in lengths]
 
-def simplify_message(message):
-    'transforms a message instance into built-in types (json encodable)'
+
+def read_lines(file, stop):
+    'yields the lines of a file up to the byte offset ``stop``'
+
+    position = file.tell()
+    while position < stop:
+        line = file.readline()
+        if not line: return
+
+        yield line[:stop - position]
+        position += len(line)
+
+
+def read_message(data):
+    'creates a message instance from the raw bytes following a "From " line'
+
+    return mailbox.mboxMessage(data)
+
+
+def simplify_message(message, headers=DEFAULT_HEADERS):
+    '''
+    transforms a message instance into built-in types (json encodable)
+
+    Only the ``headers`` (simplified names, ``None`` for all of them) are
+    decoded and kept, the rest of the headers are never decoded.
+    '''
 
     assert not message.is_multipart()
-    headers = NS((k.replace('-', '_').lower(), decode(v))
-                  for k, v in message.items())
+    view = LazyHeaders(message)
+    result = view.persist(headers)
 
     # if the @ is not found or after the first space
-    sender = headers.get('from', '')
+    sender = view.get('from', '')
     at = sender.find('@')
     if sender and (at == -1 or sender.find(' ') < at):
         sender = sender.replace(' at ', '@')
@@ -89,16 +648,45 @@ def simplify_message(message):
         # headers['from'] = sender
 
     if sender:
-        headers['from_hash'] = md5(sender.encode('utf-8')).hexdigest()
+        result['from_hash'] = md5(sender.encode('utf-8')).hexdigest()
 
-    date = headers.get('date')
+    date = view.get('date')
     if date:
-        utc = dateparser(date).astimezone(UTC)
-        headers['date_utc'] = int(time.mktime(utc.timetuple()))
+        result['date_utc'] = normalize_date(date)
 
-    message_id = headers.get('message_id')
+    message_id = view.get('message_id')
     if message_id:
-        message_id_hash = sha1(message_id.encode('utf-8')).hexdigest()
-        headers['message_id_hash'] = message_id_hash
+        result['message_id_hash'] = hash_message_id(message_id)
+
+    return Message(headers=result, payload = message.get_payload())
+
+
+def split_mbox(fileobj):
+    '''
+    yields the messages of a mbox stream one at a time (only the current
+    message is kept in memory so any readable file object can be used)
+    '''
+
+    lines = None
+    for line in fileobj:
+        if line.startswith(FROM_LINE):
+            if lines is not None:
+                yield read_message(strip_separator(lines))
+
+            lines = []
+
+        # anything before the first "From " line is not a message
+        elif lines is not None:
+            lines.append(line)
+
+    if lines is not None:
+        yield read_message(strip_separator(lines))
+
+
+def strip_separator(lines):
+    'joins the lines of a message dropping the blank line before the next one'
+
+    if lines and lines[-1] == LINESEP:
+        lines.pop()
 
-    return NS(headers=headers, payload = message.get_payload())
+    return b''.join(lines)
@@ -4,6 +4,8 @@ from __future__ import unicode_literals
 
 import re
 
+from keyword import iskeyword
+
 try: basestring
 except NameError: basestring = str
 
@@ -15,6 +17,182 @@ class NS(dict):
     def __setattr__(self, key, value): self[key] = value
 
 
+def record_fields(*keys):
+    '''
+    returns the ``FIELDS``, ``SLOTS`` and ``__slots__`` of a ``Record`` with
+    the given keys (keywords get a trailing "_" to be valid slot names)
+    '''
+
+    fields = tuple((key, key + '_' if iskeyword(key) else key) for key in keys)
+    return fields, dict(fields), tuple(slot for _, slot in fields)
+
+
+class Record(object):
+    '''
+    compact (``__slots__``) alternative to ``NS`` for the structures created
+    for every message
+
+    A record is used like a ``dict`` (which keeps templates working), its
+    known keys are stored in slots and any other key in an overflow ``dict``.
+    Records are encoded by ``json`` given ``json_default``.
+    '''
+
+    __slots__ = ('extra',)
+
+    FIELDS = ()
+    SLOTS = {}
+
+    def __init__(self, *args, **kargs):
+        for key, value in dict(*args, **kargs).items():
+            self[key] = value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+
+        return True
+
+    def __delitem__(self, key):
+        try:
+            slot = self.SLOTS.get(key)
+            if slot is not None:
+                object.__delattr__(self, slot)
+            else:
+                del object.__getattribute__(self, 'extra')[key]
+        except AttributeError:
+            raise KeyError(key)
+
+    def __eq__(self, other):
+        try:
+            return dict(self.items()) == dict(other.items())
+        except AttributeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __getattr__(self, key):
+        # only called for unset slots and keys in the overflow ``dict``
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __getitem__(self, key):
+        try:
+            slot = self.SLOTS.get(key)
+            if slot is not None:
+                return object.__getattribute__(self, slot)
+            else:
+                return object.__getattribute__(self, 'extra')[key]
+        except AttributeError:
+            raise KeyError(key)
+
+    def __getstate__(self):
+        return dict(self.items())
+
+    def __iter__(self):
+        for key, slot in self.FIELDS:
+            try:
+                object.__getattribute__(self, slot)
+            except AttributeError:
+                continue
+
+            yield key
+
+        try:
+            extra = object.__getattribute__(self, 'extra')
+        except AttributeError:
+            return
+
+        for key in extra:
+            yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, dict(self.items()))
+
+    def __setitem__(self, key, value):
+        slot = self.SLOTS.get(key)
+        if slot is not None:
+            object.__setattr__(self, slot, value)
+            return
+
+        try:
+            extra = object.__getattribute__(self, 'extra')
+        except AttributeError:
+            extra = {}
+            object.__setattr__(self, 'extra', extra)
+
+        extra[key] = value
+
+    __setattr__ = __setitem__
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            self[key] = value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[key] for key in self]
+
+
+class Headers(Record):
+    'the simplified headers of a message'
+
+    FIELDS, SLOTS, __slots__ = record_fields(
+        'cc', 'date', 'date_utc', 'from', 'from_hash', 'in_reply_to',
+        'message_id', 'message_id_hash', 'references', 'subject', 'to',
+    )
+
+
+class Message(Record):
+    'a simplified message (``next`` and ``previous`` are set by threading)'
+
+    FIELDS, SLOTS, __slots__ = record_fields('headers', 'payload', 'next',
+                                             'previous')
+
+
+class Node(Record):
+    'a message and its replies in a thread'
+
+    FIELDS, SLOTS, __slots__ = record_fields('message', 'children')
+
+
+class Paging(Record):
+    'the data structure expected by the paging controls'
+
+    FIELDS, SLOTS, __slots__ = record_fields('message_id', 'message_id_hash',
+                                             'from', 'subject')
+
+
+def json_default(value):
+    'encodes records (use as the ``default`` of ``json`` encoders)'
+
+    if isinstance(value, Record):
+        return dict(value.items())
+
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
 NAME_PATTERN = re.compile(r'(?<=\()[^()]+(?=\))')
 def simple_from(name):
     'returns the "from" in the parenthesis if possible'
@@ -31,12 +209,12 @@ def paging_info(message):
 
     headers = message.headers
 
-    return {
-        'message_id': headers.message_id,
-        'message_id_hash': headers.message_id_hash,
-        'from': simple_from(headers['from']),
-        'subject': headers.subject,
-    }
+    return Paging(
+        message_id=headers.message_id,
+        message_id_hash=headers.message_id_hash,
+        subject=headers.subject,
+        **{'from': simple_from(headers['from'])}
+    )
 
 
 def wrap_dictionaries(value):
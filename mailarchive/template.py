@@ -0,0 +1,438 @@
+# vim: set fileencoding=utf-8 :
+
+from __future__ import unicode_literals
+
+import marshal
+import os
+import sys
+
+from hashlib import sha1
+from jsontemplate import _jsontemplate as jsontemplate # bad __all__
+from os import makedirs, path, remove, rename
+from tempfile import NamedTemporaryFile
+
+try:
+    from importlib.util import MAGIC_NUMBER
+except ImportError:
+    from imp import get_magic
+    MAGIC_NUMBER = get_magic()
+
+try: basestring
+except NameError: basestring = str
+
+# compiled templates are cached by the digest of the template, its options,
+# the Python version and ``COMPILER_VERSION`` (to be bumped when the
+# generated code changes)
+CACHE_DIRECTORY = path.join(os.environ.get('XDG_CACHE_HOME') or
+                            path.join(path.expanduser('~'), '.cache'),
+                            'mailarchive')
+CACHE_SUFFIX = '.jstc'
+COMPILER_VERSION = 1
+
+COMPILE_OPTIONS = (('meta', '{}'), ('format_char', '|'),
+                   ('default_formatter', 'str'), ('whitespace', 'smart'))
+
+SIMPLE_FUNC = jsontemplate.SIMPLE_FUNC
+TEMPLATE_FORMATTER = jsontemplate.TEMPLATE_FORMATTER
+
+
+class _Unsupported(Exception):
+    'raised for the template features only the interpreter supports'
+
+
+class _Builder(jsontemplate._ProgramBuilder):
+    '''
+    builds the program tree like ``jsontemplate`` but keeps the names of the
+    formatters and predicates (the code is cached, the functions are not)
+    '''
+
+    def _GetFormatter(self, format_str):
+        _, args, func_type = \
+            super(_Builder, self)._GetFormatter(format_str)
+
+        if func_type == TEMPLATE_FORMATTER:
+            raise _Unsupported(format_str)
+
+        return ('formatter', format_str, False), args, func_type
+
+    def _GetPredicate(self, pred_str, test_attr=False):
+        _, args, func_type = \
+            super(_Builder, self)._GetPredicate(pred_str, test_attr)
+
+        return ('predicate', pred_str, test_attr), args, func_type
+
+    def AppendTemplateSubstitution(self, name):
+        raise _Unsupported(name)
+
+    def NewSection(self, token_type, section_name, pre_formatters):
+        if token_type == jsontemplate.DEF_TOKEN:
+            raise _Unsupported(section_name)
+
+        super(_Builder, self).NewSection(token_type, section_name,
+                                         pre_formatters)
+
+
+class _Compiler(object):
+    '''
+    generates the source of ``execute(c0, write)`` for a program tree
+
+    The frames of ``jsontemplate``'s scoped context are local variables
+    (a context and, in repeated sections, an index), known while compiling.
+    The formatters and predicates are the globals ``f0``, ``f1``, ... (their
+    arguments ``a0``, ``a1``, ...) named by ``symbols``.
+    '''
+
+    def __init__(self):
+        self.lines = ['def execute(c0, write):']
+        self.symbols = []
+        self.variables = 0
+
+    def call(self, value, function, frames):
+        key, args, func_type = function
+        try:
+            symbol = self.symbols.index((key, func_type))
+        except ValueError:
+            symbol = len(self.symbols)
+            self.symbols.append((key, func_type))
+
+        if func_type == SIMPLE_FUNC:
+            return 'f%d(%s)' % (symbol, value)
+
+        return 'f%d(%s, context((%s,), (%s,)), a%d)' % (
+            symbol, value, ', '.join(context for context, _ in frames),
+            ', '.join(index or '-1' for _, index in frames), symbol)
+
+    def emit(self, depth, line):
+        self.lines.append('    ' * depth + line)
+
+    def lookup(self, name, frames):
+        if name == '@':
+            return frames[-1][0]
+
+        parts = name.split('.')
+        if parts[0] == '@index':
+            indices = [index for _, index in frames if index]
+            value = indices[-1] if indices else 'undefined(%r)' % parts[0]
+        else:
+            value = 'lookup((%s,), %r)' % (
+                ', '.join(context for context, _ in reversed(frames)),
+                parts[0])
+
+        for part in parts[1:]:
+            value = 'index(%s, %r)' % (value, part)
+
+        return value
+
+    def predicates(self, block, frames, depth):
+        keyword = 'if'
+        for predicate, statements in block.clauses:
+            if callable(predicate[0]): # a plain {.or}
+                self.emit(depth, 'else:')
+                self.statements(statements, frames, depth + 1)
+                break
+
+            self.emit(depth, '%s %s:' % (
+                keyword, self.call(frames[-1][0], predicate, frames)))
+            self.statements(statements, frames, depth + 1)
+            keyword = 'elif'
+
+    def section(self, block, frames, depth, repeated=False):
+        self.variables += 1
+        value = 'c%d' % self.variables
+        name = block.section_name
+
+        self.emit(depth, '%s = %s' % (value, frames[-1][0] if name == '@'
+                                      else '%s.get(%r)' % (frames[-1][0],
+                                                           name)))
+        for formatter in block.pre_formatters:
+            self.emit(depth, '%s = %s' % (value,
+                                          self.call(value, formatter,
+                                                    frames)))
+
+        self.emit(depth, 'if %s:' % value)
+        if not repeated:
+            self.statements(block.Statements(), frames + [(value, None)],
+                            depth + 1)
+        else:
+            self.emit(depth + 1, 'if not isinstance(%s, list):' % value)
+            self.emit(depth + 2, 'raise EvaluationError('
+                                 '"Expected a list; got %%s" %% type(%s))'
+                                 % value)
+
+            self.variables += 1
+            item, index, count = ['%s%d' % (prefix, self.variables)
+                                  for prefix in 'cin']
+            items = frames + [(value, None), (item, index)]
+            alternates = block.Statements('alternates with')
+
+            if alternates:
+                self.emit(depth + 1, '%s = len(%s)' % (count, value))
+
+            self.emit(depth + 1, 'for %s, %s in enumerate(%s, 1):' % (
+                index, item, value))
+            self.statements(block.Statements(), items, depth + 2)
+
+            if alternates:
+                self.emit(depth + 2, 'if %s != %s:' % (index, count))
+                self.statements(alternates, items, depth + 3)
+
+            # the {.or} of a repeated section sees the (empty) list
+            frames = frames + [(value, None)]
+
+        if block.Statements('or'):
+            self.emit(depth, 'else:')
+            self.statements(block.Statements('or'), frames, depth + 1)
+
+    def statements(self, statements, frames, depth):
+        start = len(self.lines)
+        literals = []
+        for statement in statements + [None]:
+            if isinstance(statement, basestring):
+                literals.append(statement)
+                continue
+
+            if literals:
+                self.emit(depth, 'write(%r)' % literals[0][:0].join(literals))
+                literals = []
+
+            if statement is None:
+                break
+
+            function, block = statement
+            if function is jsontemplate._DoSubstitute:
+                self.substitute(block[0], block[1], frames, depth)
+            elif function is jsontemplate._DoSection:
+                self.section(block, frames, depth)
+            elif function is jsontemplate._DoRepeatedSection:
+                self.section(block, frames, depth, repeated=True)
+            elif function is jsontemplate._DoPredicates:
+                self.predicates(block, frames, depth)
+            else:
+                raise _Unsupported(function)
+
+        if len(self.lines) == start:
+            self.emit(depth, 'pass')
+
+    def substitute(self, name, formatters, frames, depth):
+        self.emit(depth, 'v = %s' % self.lookup(name, frames))
+        for formatter in formatters:
+            self.emit(depth, 'try:')
+            self.emit(depth + 1, 'v = %s' % self.call('v', formatter, frames))
+            self.emit(depth, 'except Exception as e:')
+            self.emit(depth + 1, 'fail(%r, v, %r, e)' % (name,
+                                                         formatter[0][1]))
+
+        self.emit(depth, 'if v is None:')
+        self.emit(depth + 1, 'raise EvaluationError('
+                             '"Evaluating %%r gave None value" %% %r)' % name)
+        self.emit(depth, 'write(v)')
+
+
+def _compile_program(template_str, options, formatters, predicates):
+    '''
+    returns the code of a template and the (key, type) pairs of the
+    formatters and predicates it uses
+    '''
+
+    builder = _Builder(formatters, predicates,
+                       jsontemplate._TemplateRegistry(None))
+    program, has_defines = jsontemplate._CompileTemplate(template_str,
+                                                         builder, **options)
+    if has_defines:
+        raise _Unsupported('define')
+
+    compiler = _Compiler()
+    compiler.statements(program.Statements(), [('c0', None)], 1)
+
+    source = '\n'.join(compiler.lines) + '\n'
+    return (compile(source, '<template>', 'exec', 0, True),
+            tuple(compiler.symbols))
+
+
+def _fail(name, value, formatter, error):
+    'wraps the errors of formatters like ``jsontemplate``'
+
+    if isinstance(error, jsontemplate.EvaluationError):
+        raise
+
+    raise jsontemplate.EvaluationError(
+        'Formatting name %r, value %r with formatter %s raised exception: %r '
+        '-- see e.original_exc_info' % (name, value, formatter, error),
+        original_exc_info=sys.exc_info())
+
+
+def _load_program(directory, digest):
+    'returns a cached program (``None`` if it is missing or unreadable)'
+
+    try:
+        with open(path.join(directory, digest + CACHE_SUFFIX), 'rb') as file:
+            return marshal.loads(file.read())
+    except (IOError, OSError, EOFError, TypeError, ValueError):
+        return None
+
+
+def _save_program(directory, digest, program):
+    'caches a program (atomically, the cache is shared by processes)'
+
+    try:
+        if not path.isdir(directory):
+            makedirs(directory)
+
+        with NamedTemporaryFile(dir=directory, suffix='.tmp',
+                                delete=False) as file:
+            file.write(marshal.dumps(program))
+
+        try:
+            rename(file.name, path.join(directory, digest + CACHE_SUFFIX))
+        except OSError:
+            remove(file.name)
+            raise
+    except (IOError, OSError):
+        pass # the cache is an optimization
+
+
+class CompiledTemplate(object):
+    '''
+    a ``jsontemplate.Template`` compiled to a Python function
+
+    The template is parsed by ``jsontemplate`` and each section, repeated
+    section, predicate and substitution becomes straight Python code, saving
+    the interpretation of the program tree on every expansion. The code is
+    cached in ``cache`` (``None`` disables it) by the digest of the template
+    and its compile options, the formatters are resolved again on load.
+
+    ``{{.define}}`` and ``{{.template}}`` raise ``_Unsupported``, see
+    ``compile_template``.
+    '''
+
+    def __init__(self, template_str, more_formatters=lambda name: None,
+                 more_predicates=lambda name: None, undefined_str=None,
+                 cache=CACHE_DIRECTORY, **compile_options):
+
+        options = dict(COMPILE_OPTIONS)
+        options.update(compile_options)
+
+        resolver = jsontemplate._ProgramBuilder(
+            more_formatters, more_predicates,
+            jsontemplate._TemplateRegistry(self))
+
+        self.undefined_str = undefined_str
+        self.digest = template_digest(template_str, options)
+
+        program = cache and _load_program(cache, self.digest)
+        namespace = program and self._resolve(program, resolver)
+        if not namespace:
+            program = _compile_program(template_str, options,
+                                       more_formatters, more_predicates)
+            namespace = self._resolve(program, resolver)
+            if cache:
+                _save_program(cache, self.digest, program)
+
+        self.execute = namespace['execute']
+
+    def _context(self, contexts, indices):
+        'returns the ``jsontemplate`` context of the enhanced functions'
+
+        context = jsontemplate._ScopedContext(contexts[0], self.undefined_str)
+        context.stack = [jsontemplate._Frame(frame, index)
+                         for frame, index in zip(contexts, indices)]
+
+        return context
+
+    def _resolve(self, program, resolver):
+        '''
+        returns the namespace of the code of a program (``None`` if its
+        formatters or predicates changed type)
+        '''
+
+        code, symbols = program
+        undefined_str = self.undefined_str
+
+        def undefined(name):
+            if undefined_str is None:
+                raise jsontemplate.UndefinedVariable('%r is not defined' %
+                                                     name)
+            return undefined_str
+
+        def lookup(contexts, name):
+            for context in contexts:
+                if hasattr(context, 'get'):
+                    try:
+                        return context[name]
+                    except KeyError:
+                        pass
+
+            return undefined(name)
+
+        def index(value, name):
+            try:
+                return value[name]
+            except (KeyError, TypeError):
+                return undefined(name)
+
+        namespace = dict(EvaluationError=jsontemplate.EvaluationError,
+                         context=self._context, fail=_fail, index=index,
+                         lookup=lookup, undefined=undefined)
+
+        for i, ((kind, name, test_attr), func_type) in enumerate(symbols):
+            try:
+                if kind == 'formatter':
+                    function, args, actual = resolver._GetFormatter(name)
+                else:
+                    function, args, actual = \
+                        resolver._GetPredicate(name, test_attr)
+            except jsontemplate.CompilationError:
+                return None
+
+            if actual != func_type:
+                return None
+
+            namespace['f%d' % i], namespace['a%d' % i] = function, args
+
+        exec(code, namespace)
+        return namespace
+
+    def expand(self, *args, **kargs):
+        'expands the template with a data dictionary (or keyword arguments)'
+
+        if len(args) > 1:
+            raise TypeError('expand() only takes 1 positional argument '
+                            '(got %s)' % (args,))
+
+        tokens = []
+        self.execute(args[0] if args else kargs, tokens.append)
+
+        return jsontemplate.JoinTokens(tokens)
+
+
+def compile_template(template_str, **kargs):
+    '''
+    returns a ``CompiledTemplate``, or a ``jsontemplate.Template`` if the
+    template uses features which are not compiled
+    '''
+
+    try:
+        return CompiledTemplate(template_str, **kargs)
+    except _Unsupported:
+        kargs.pop('cache', None)
+        template = jsontemplate.Template(template_str, **kargs)
+
+    # ``execute`` (used to stream the output) needs the {.define}s too
+    template._SetTemplateGroup(jsontemplate._MakeGroupFromRootSection(
+        template._program, template.undefined_str))
+
+    return template
+
+
+def template_digest(template_str, options):
+    'returns the cache key of a template and its compile options'
+
+    digest = sha1(MAGIC_NUMBER)
+    digest.update(repr((COMPILER_VERSION, sorted(options.items())))
+                  .encode('utf-8'))
+
+    if not isinstance(template_str, bytes):
+        template_str = template_str.encode('utf-8')
+    digest.update(template_str)
+
+    return digest.hexdigest()
@@ -2,29 +2,217 @@
 
 from __future__ import unicode_literals
 
-from collections import Counter, deque
+import json
 
-from mailarchive.shared import NS, paging_info
+from bisect import bisect, bisect_left
+from collections import deque
 
+from mailarchive.shared import NS, Headers, Message, Node, paging_info
 
-class CounterList(list):
+
+class ThreadGraph(object):
     '''
-    creates a list which returns an empty counter when the index is out of
-    bounds
+    the threads of an archive kept between runs, adding messages only
+    threads them again with the threads they are connected to (through a
+    message id or reference) and only ties those threads and their
+    neighbours again
+
+    The threads are kept in the order of the threading engines (see
+    ``THREADERS``), out of range threads first.
     '''
 
-    def __getitem__(self, index):
+    def __init__(self, threading='in-reply-to', threads=(), key=None):
+        self.threading = threading
+        self.key = key or date_and_subject
+
+        # sorted (order, serial) pairs, the threads and their ids by serial
+        self.entries = []
+        self.nodes = {}
+        self.ids = {}
+
+        # message id (or reference) to the serials of the threads using it
+        self.owners = {}
+        self.serial = 0
+
+        for thread in threads:
+            self.insert(thread)
+
+    def __iter__(self):
+        return (self.nodes[serial] for _, serial in self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, messages):
+        '''
+        threads new messages (replacing messages with the same id), only the
+        threads they are connected to are threaded again and only those and
+        the threads next to them are tied again
+        '''
+
+        messages = list(messages)
+
+        # every thread connected to the new messages is threaded again
+        seen, affected = set(), set()
+        pending = set(i for m in messages for i in message_ids(m))
+        while pending:
+            id = pending.pop()
+            seen.add(id)
+
+            for serial in self.owners.get(id, ()):
+                if serial not in affected:
+                    affected.add(serial)
+                    pending.update(self.ids[serial] - seen)
+
+        old = []
+        neighbours = set()
+        for serial in affected:
+            old.extend(walk_thread(self.nodes[serial]))
+            neighbours.update(self.around(serial))
+
+        for serial in affected:
+            self.remove(serial)
+
+        # messages added later replace earlier ones with the same id
+        added = [self.insert(thread) for thread in
+                 THREADERS[self.threading](old + messages, key=self.key)]
+
+        for serial in added:
+            neighbours.update(self.around(serial))
+
+        neighbours -= affected | set(added)
+        for serial in added + list(neighbours):
+            self.tie(serial)
+
+    def around(self, serial):
+        'returns the serials of a thread and the threads next to it'
+
+        index = self.position(serial)
+        return [s for _, s in self.entries[max(0, index - 1):index + 2]]
+
+    def flatten(self):
+        'returns the threads like ``flatten_threads``'
+
+        return list(flatten_threads(self))
+
+    @staticmethod
+    def ids_of(thread):
+        'yields the message ids and references of a thread'
+
+        yield thread.message.headers.message_id
+        for message in walk_thread(thread):
+            headers = message.headers
+            yield headers.message_id
+            yield headers.get('in_reply_to')
+
+            for id in (headers.get('references') or '').split():
+                yield id
+
+    def insert(self, thread):
+        'stores a thread (its messages are not tied) and returns its serial'
+
+        serial = self.serial
+        self.serial += 1
+
+        entry = (self.order(thread), serial)
+        self.entries.insert(bisect(self.entries, entry), entry)
+        self.nodes[serial] = thread
+
+        ids = set(self.ids_of(thread))
+        ids.discard(None)
+        self.ids[serial] = ids
+        for id in ids:
+            self.owners.setdefault(id, set()).add(serial)
+
+        return serial
+
+    @classmethod
+    def load(cls, filename, threading='in-reply-to', key=None):
+        '''
+        loads the graph of the threads written by ``flatten`` (``None`` if
+        the file is missing or corrupt), they must have been threaded with
+        the ``threading`` engine
+        '''
+
         try:
-            return super(CounterList, self).__getitem__(index)
-        except IndexError:
-            return Counter()
+            with open(filename, 'rb') as file:
+                data = json.loads(file.read().decode('utf-8'),
+                                  object_hook=NS)
+        except (IOError, ValueError):
+            return None
+
+        return cls(threading, key=key, threads=(
+            unflatten_thread(top, messages) for top, messages in data
+        ))
+
+    def messages(self):
+        'yields the messages of every thread'
+
+        for thread in self:
+            for message in walk_thread(thread):
+                yield message
+
+    def order(self, thread):
+        'returns the sort key of a thread'
+
+        if 'payload' in thread.message:
+            return (1, self.key(thread.message))
+
+        return (0, self.key(thread.children[0].message))
+
+    def position(self, serial):
+        'returns the index of a thread in the sorted threads'
+
+        return bisect_left(self.entries, (self.order(self.nodes[serial]),
+                                          serial))
+
+    def remove(self, serial):
+        'removes a thread'
+
+        del self.entries[self.position(serial)]
+        self.nodes.pop(serial)
+
+        for id in self.ids.pop(serial):
+            owners = self.owners[id]
+            owners.discard(serial)
+            if not owners: del self.owners[id]
+
+    def tie(self, serial):
+        '''
+        ties the messages of a thread like ``tie_threads`` given its
+        neighbouring threads
+        '''
+
+        index = self.position(serial)
+
+        previous = following = None
+        if index > 0:
+            for last in walk_thread(self.nodes[self.entries[index - 1][1]]):
+                pass
+
+            previous = paging_info(last)
+
+        if index + 1 < len(self.entries):
+            following = paging_info(first_message(
+                self.nodes[self.entries[index + 1][1]]
+            ))
+
+        messages = list(walk_thread(self.nodes[serial]))
+        pages = [previous] + [paging_info(m) for m in messages] + [following]
+        for index, message in enumerate(messages):
+            message.previous = pages[index]
+            message.next = pages[index + 2]
 
 
 def date_and_subject(message):
-    'returns the data and subject headers'
+    '''
+    returns the date and subject headers (and the message id, so messages
+    sent at the same time with the same subject are always in the same
+    order)
+    '''
 
     headers = message.headers
-    return (headers.date_utc, headers.subject)
+    return (headers.date_utc, headers.subject, headers.message_id)
 
 
 def build_chains(messages, key=date_and_subject):
@@ -36,7 +224,7 @@ def build_chains(messages, key=date_and_subject):
                 for h in (m.headers for m in messages))
 
 
-    chains = dict((id, NS(message=by_id[id], children=[])) for id in info)
+    chains = dict((id, Node(message=by_id[id], children=[])) for id in info)
 
     for id, reply_to in info.items():
         if reply_to is None: continue
@@ -47,7 +235,7 @@ def build_chains(messages, key=date_and_subject):
         # reply_to is not a key to info: invalid message specified
         # or not in range (treat as not in range)
         except KeyError:
-            chains[reply_to] = NS(message=None, children=[chains[id]])
+            chains[reply_to] = Node(message=None, children=[chains[id]])
 
     # sort the children in place
     for children in (v.children for v in chains.values()):
@@ -64,24 +252,6 @@ def build_threads(messages, key=date_and_subject):
         yield thread
 
 
-def child_references(thread):
-    'convert the references string into a more easily merged structure'
-
-    result = []
-    for refs in (c.message.headers.get('references')
-                 for c in thread.children):
-
-        if not refs: continue
-        # email references are appended the end of the header
-        for index, ref in enumerate(reversed(refs.split())):
-            try:
-                result[index][ref] = result[index].get(ref, 0) + 1
-            except IndexError:
-                result.append({ref:1})
-
-    return [Counter(i) for i in result]
-
-
 def dummy_node(**kargs):
     '''
     create a message stub (for joining and representing out of range messages)
@@ -99,8 +269,9 @@ def dummy_node(**kargs):
         message_id = kargs['message_id']
         subject = kargs['subject']
 
-    return NS(
-        message = NS(headers=NS(message_id=message_id, subject=subject)),
+    return Node(
+        message = Message(headers=Headers(message_id=message_id,
+                                          subject=subject)),
         children = children,
     )
 
@@ -114,34 +285,83 @@ def first_message(thread):
     return thread.message
 
 
-def flatten_threads(threads):
+def flatten_thread(thread):
     '''
     flatten a thread into a top level message and its replies as a list
     in a depth first order
+
+    The top's ``parents`` are the indices of the messages' parents in the
+    list (-1 for the top of the thread), see ``unflatten_thread``.
     '''
 
+    headers = thread.message.headers
+    messages, parents = [], []
+
+    queue = deque([(thread, -1)])
+    while queue:
+        thread, parent = queue.popleft()
+        if 'payload' in thread.message:
+            messages.append(thread.message)
+            parents.append(parent)
+            parent = len(messages) - 1
+
+        queue.extendleft(reversed([(c, parent) for c in thread.children]))
+
+    # all normalized messages will have a message_id and subject
+    top = dict(message_id=headers.message_id, subject=headers.subject,
+               parents=parents)
+
+    return top, messages
+
+
+def flatten_threads(threads):
+    'flattens threads (see ``flatten_thread``)'
+
     for thread in threads:
-        headers = thread.message.headers
-        # all normalized messages will have a message_id and subject
-        top = dict(message_id=headers.message_id, subject=headers.subject)
+        yield flatten_thread(thread)
 
-        queue = deque([thread])
-        messages = []
-        while queue:
-            thread = queue.popleft()
-            queue.extendleft(reversed(thread.children))
 
-            if 'payload' in thread.message:
-                messages.append(thread.message)
+def merge_root(references):
+    '''
+    returns the message id to join threads on given their references (see
+    ``thread_references``): the id referenced by the most threads, then the
+    most replies, then the one closest to the replies and finally the first
+    one referenced
+    '''
 
-        yield top, messages
+    tally = {}
+    for refs in references:
+        for id, (count, level) in sorted(refs.items(), key=lambda i: i[1][1]):
+            threads, total, closest, first = tally.get(id, (0, 0, level,
+                                                            len(tally)))
+            tally[id] = (threads + 1, total + count, min(closest, level),
+                         first)
+
+    return max(tally, key=lambda id: (tally[id][0], tally[id][1],
+                                      -tally[id][2], -tally[id][3]))
+
+
+def message_ids(message):
+    'yields the id, In-Reply-To and references of a message'
+
+    headers = message.headers
+    yield headers.message_id
+
+    if headers.get('in_reply_to'):
+        yield headers.in_reply_to
+
+    for id in (headers.get('references') or '').split():
+        yield id
 
 
 def normalize_threads(threads):
     '''
     normalize threads by creating dummy nodes (messages) to represent
-    out of range messages, and then merges as many threads as possible
-    based on the threads replies' references
+    out of range messages, and then merges the threads whose replies share a
+    reference anywhere in their reference lists
+
+    The threads are merged with a union find over an inverted index of the
+    referenced message ids, so this is linear in the number of references.
     '''
 
     threads = iter(threads)
@@ -149,71 +369,205 @@ def normalize_threads(threads):
     # find all the threads which are out of range (possible merges)
     out_of_range = []
     first = None
-    try:
-        while True:
-            thread = next(threads)
-            if thread.message is None:
-                out_of_range.append((child_references(thread),
-                                     dummy_node(thread=thread)))
-            else:
-                first = thread
-                break
-    except StopIteration:
-        pass
-
-    # make sure all the references start the same length and strip the first
-    # reference because we already know valid references would indicate this
-    # is their parent because it was in their "in_reply_to" header
-    if out_of_range:
-        length = max(len(i[0]) for i in out_of_range)
-        out_of_range = [(CounterList(r[1:] + [Counter()] * (length - len(r))),
-                         t)
-                        for r, t in out_of_range]
-
-    # TODO: find merge partners anywhere in the reference list
-    # try to merge the threads
-    merged = []
-    while out_of_range:
-        refs, thread = out_of_range.pop(0)
-
-        common = [i for i in ((refs[0] & item[0][0], i, item)
-                              for i, item in enumerate(out_of_range)) if i[0]]
-
-        # if there were no common references put the thread aside
-        if not common:
-            merged.append((refs, thread))
+    for thread in threads:
+        if thread.message is not None:
+            first = thread
+            break
+
+        out_of_range.append(thread)
+
+    references = [thread_references(t) for t in out_of_range]
+    parents = list(range(len(out_of_range)))
+
+    def find(index):
+        while parents[index] != index:
+            parents[index] = index = parents[parents[index]]
+
+        return index
+
+    # join every thread with the first thread referencing the same id (the
+    # earliest thread of a group is always its root)
+    owners = {}
+    for index, refs in enumerate(references):
+        for id in refs:
+            owner = find(owners.setdefault(id, index))
+            root = find(index)
+            if owner != root:
+                parents[max(owner, root)] = min(owner, root)
+
+    groups = {}
+    for index in range(len(out_of_range)):
+        groups.setdefault(find(index), []).append(index)
+
+    # return the merged threads (in the order of their earliest thread), the
+    # first in range thread found, and the rest
+    for index, thread in enumerate(out_of_range):
+        group = groups.get(index)
+        if group is None: continue
+
+        if len(group) == 1:
+            yield dummy_node(thread=thread)
             continue
 
-        # go backwards so the indices to pop do not change
-        for _, index, _ in reversed(common):
-            out_of_range.pop(index)
+        # a message with only a subject will not be linked to
+        # (hopefully all the children have the same subject)
+        yield dummy_node(
+            message_id = merge_root(references[i] for i in group),
+            subject = thread.children[0].message.headers.subject,
+            children = [child for i in group
+                        for child in out_of_range[i].children]
+        )
 
-        (id, _), = sum((i[0] for i in common), Counter()).most_common(1)
+    if first is not None: yield first
+    for thread in threads: yield thread
 
-        # merge
-        refs = CounterList(
-            sum(lst, Counter()) for lst in
-            zip(*([refs[1:]] + [i[2][0][1:] for i in common]))
-        )
 
+def reference_threads(messages, key=date_and_subject):
+    '''
+    returns the messages as normalized threads (like ``normalize_threads``)
+    built from their whole References header (and In-Reply-To), the
+    container algorithm described by Jamie Zawinski
+
+    A missing message referenced by replies is kept as a stub node at the
+    top of its thread and replaced by its replies anywhere else. Unlike the
+    original algorithm threads are not joined on their subjects.
+    '''
+
+    by_id = dict((m.headers.message_id, m) for m in messages)
+    parents = {}
+    linked = set()
+
+    def link(parent, child):
+        # refuse links which would create a loop (only a message with replies
+        # can be an ancestor of its parent, the others are never walked)
+        if parent == child: return
+
+        ancestor = parent if child in linked else None
+        while ancestor is not None:
+            if ancestor == child: return
+            ancestor = parents.get(ancestor)
+
+        parents[child] = parent
+        linked.add(parent)
+
+    # the earliest message places a missing message (whatever the order of
+    # the messages given)
+    for id, message in sorted(by_id.items(), key=lambda i: key(i[1])):
+        headers = message.headers
+        refs = [r for r in (headers.get('references') or '').split()
+                if r != id]
+
+        in_reply_to = headers.get('in_reply_to')
+        if in_reply_to and in_reply_to != id and in_reply_to not in refs[-1:]:
+            refs.append(in_reply_to)
+
+        # a message's own headers place it, the references of other
+        # messages only place the messages which are missing
+        for parent, child in zip(refs, refs[1:]):
+            if child not in by_id and child not in parents:
+                link(parent, child)
+
+        if refs: link(refs[-1], id)
+
+    # the closest ancestor the replies of a missing message are moved to
+    anchors = {}
+    def anchor(id):
+        path = []
+        while id not in by_id and id in parents and id not in anchors:
+            path.append(id)
+            id = parents[id]
+
+        id = anchors.get(id, id)
+        for missing in path: anchors[missing] = id
+        return id
+
+    nodes = dict((id, Node(message=m, children=[]))
+                 for id, m in by_id.items())
+
+    roots, stubs = [], {}
+    for id, node in nodes.items():
+        parent = parents.get(id)
+        if parent is None:
+            roots.append(node)
+            continue
+
+        parent = anchor(parent)
+        if parent in nodes:
+            nodes[parent].children.append(node)
+        else:
+            stubs.setdefault(parent, []).append(node)
+
+    sort_key = lambda x: key(x.message)
+    for children in [n.children for n in nodes.values()] + \
+                    list(stubs.values()):
+        children.sort(key=sort_key)
+
+    # the out of range threads first (like ``top_level_chains``)
+    for id, children in sorted(stubs.items(),
+                               key=lambda i: sort_key(i[1][0])):
         # a message with only a subject will not be linked to
-        # (hopefully all the children have the same subject)
-        joined = dummy_node(
-            message_id = id,
-            subject = thread.message.headers.subject,
-            children = sum((i[2][1].children for i in common),
-                           thread.children)
-        )
+        yield dummy_node(message_id=id,
+                         subject=children[0].message.headers.subject,
+                         children=children)
 
-        # a merge was performed so retry all threads
-        out_of_range = merged + [(refs, joined)] + out_of_range
-        merged = []
+    for node in sorted(roots, key=sort_key):
+        yield node
 
 
-    # return the merged threads, the first in range thread found, and the rest
-    for _, thread in merged: yield thread
-    if first is not None: yield first
-    for thread in threads: yield thread
+def reply_threads(messages, key=date_and_subject):
+    'returns the normalized threads built from the In-Reply-To headers'
+
+    return normalize_threads(build_threads(messages, key=key))
+
+
+def thread_references(thread):
+    '''
+    returns the message ids referenced by the replies of an out of range
+    thread mapped to how many replies reference them and how close they are
+    to the replies (0 being the missing message the replies are to)
+    '''
+
+    result = {}
+    for headers in (c.message.headers for c in thread.children):
+        in_reply_to = headers.in_reply_to
+        # email references are appended the end of the header
+        refs = (headers.get('references') or '').split()
+        ids = [in_reply_to] + [r for r in reversed(refs) if r != in_reply_to]
+
+        for level, id in enumerate(ids):
+            count, closest = result.get(id, (0, level))
+            result[id] = (count + 1, min(closest, level))
+
+    return result
+
+
+def tie_flatten_threads(threads):
+    '''
+    ties (like ``tie_threads``) and flattens (like ``flatten_threads``) the
+    threads in a single pass
+
+    Each message gets one paging record, shared as the "next" of the message
+    before it and the "previous" of the message after it.
+    '''
+
+    result = []
+    last = page = None
+
+    for thread in threads:
+        top, messages = flatten_thread(thread)
+        for message in messages:
+            message.previous = page
+            message.next = None
+
+            page = paging_info(message)
+            if last is not None:
+                last.next = page
+
+            last = message
+
+        result.append((top, messages))
+
+    return result
 
 
 def tie_threads(threads):
@@ -277,3 +631,47 @@ def top_level_chains(chains, key=date_and_subject):
     rest = set(top_level.keys()) - set(out_of_range)
     for id in sorted(rest, key=lambda x: key(chains[x].message)):
         yield top_level[id]
+
+
+def unflatten_thread(top, messages):
+    '''
+    returns the thread (a ``Node``) of a thread flattened by
+    ``flatten_thread``
+    '''
+
+    nodes = [Node(message=m, children=[]) for m in messages]
+
+    # a thread starting with an out of range message has a stub top
+    if messages and messages[0].headers.message_id == top['message_id']:
+        root = nodes[0]
+    else:
+        root = dummy_node(message_id=top['message_id'],
+                          subject=top['subject'], children=[])
+
+    for node, parent in zip(nodes, top['parents']):
+        if parent >= 0:
+            nodes[parent].children.append(node)
+        elif node is not root:
+            root.children.append(node)
+
+    return root
+
+
+def walk_thread(thread):
+    'yields the messages of a thread in depth first order (without stubs)'
+
+    queue = deque([thread])
+    while queue:
+        thread = queue.popleft()
+        queue.extendleft(reversed(thread.children))
+
+        if 'payload' in thread.message:
+            yield thread.message
+
+
+
+# the threading engines, by name
+THREADERS = {
+    'in-reply-to': reply_threads,
+    'references': reference_threads,
+}
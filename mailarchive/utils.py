@@ -3,38 +3,67 @@
 from __future__ import unicode_literals
 
 import codecs
+import errno
 import json
 import pkg_resources
 import re
+import socket
 import sys
 import shutil
+import threading
 import yaml
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 from collections import deque
 from contextlib import closing
+from filecmp import cmp
+from functools import partial
+from glob import glob, has_magic
 from gzip import GzipFile
+from hashlib import sha1
 from io import BytesIO, open
 from itertools import groupby
 from jsontemplate import _jsontemplate as jsontemplate # bad __all__
-from os import listdir, makedirs, path
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from os import chmod, fdopen, listdir, makedirs, path, remove, rename, \
+               rmdir, umask, utime
+from string import ascii_lowercase
+from tempfile import NamedTemporaryFile, mkdtemp, mkstemp
+from time import gmtime, strftime
+
+from mailarchive.parse import DEFAULT_HEADERS, FROM_LINE, Deduplicator, \
+                              MboxIndex, header_name, parse_mbox, \
+                              prefix_checksums
+from mailarchive.shared import NS, Node, json_default, paging_info, \
+                               simple_from, wrap_dictionaries
+from mailarchive.template import compile_template
+
+from mailarchive.thread import THREADERS, ThreadGraph, first_message, \
+                               tie_flatten_threads, unflatten_thread, \
+                               walk_thread
 
-from mailarchive.parse import parse_mbox
-from mailarchive.shared import NS, paging_info, simple_from, wrap_dictionaries
-
-from mailarchive.thread import build_threads, flatten_threads, \
-                               normalize_threads, tie_threads
+try:
+    from http.client import HTTPConnection, HTTPException, HTTPSConnection
+except ImportError:
+    from httplib import HTTPConnection, HTTPException, HTTPSConnection
 
 try:
-    from urllib.request import urlopen
+    from urllib.request import getproxies, proxy_bypass, urlopen
 except ImportError:
+    from urllib import getproxies, proxy_bypass
     from urllib2 import urlopen
 
 try:
-    from urllib.parse import queue as urlescape, urlsplit
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from urllib.parse import quote as urlescape, urljoin, urlsplit
 except ImportError:
     from urllib import quote as urlescape
-    from urlparse import urlsplit
+    from urlparse import urljoin, urlsplit
 
 
 try: basestring
@@ -49,6 +78,27 @@ DEFAULT_FORMATTERS = {
     'url-param-value': lambda s: urlescape(s.encode('utf-8')),
 }
 
+# links to the monthly archives on a pipermail listing page
+ARCHIVE_PATTERN = re.compile(r'href\s*=\s*["\']?([^"\'\s>]+\.txt\.gz)', re.I)
+
+HTTP_TIMEOUT = 60
+BYTES_PER_BATCH = 1 << 20
+FINGERPRINT = 12
+FILES_PER_BATCH = 64
+MESSAGES_PER_CHUNK = 256
+MESSAGES_DIRECTORY = 'messages'
+MESSAGES_INDEX = 'index.json'
+TOKENS_PER_WRITE = 1024
+STAGING_DIRECTORY = '.staging'
+STATE_SUFFIX = '.state'
+REDIRECTS = (301, 302, 303, 307, 308)
+
+# the mode ``open`` gives new files, the staged files (private, as made by
+# ``mkstemp``) get it so a web server running as another user can read them
+UMASK = umask(0o022)
+umask(UMASK)
+FILE_MODE = 0o666 & ~UMASK
+
 
 class Path(unicode):
     'a path can either be a package resource or an actual file system path'
@@ -118,10 +168,47 @@ class Path(unicode):
             return data.decode(encoding=encoding, errors=errors)
 
 
+class Fragment(unicode):
+    '''
+    an empty string standing in for a part of a page (the expansion of
+    ``template`` with the ``dict`` returned by ``data``), ``stream_template``
+    writes it in its place
+
+    Fragments are substituted unformatted (``{{@}}``) and are empty in an
+    expanded template.
+    '''
+
+    def __new__(cls, template, data):
+        return super(Fragment, cls).__new__(cls)
+
+    def __init__(self, template, data):
+        self.template = template
+        self.data = data
+
+    def tokens(self):
+        'returns the tokens of the fragment (nested fragments unexpanded)'
+
+        tokens = []
+        self.template.execute(self.data(), tokens.append)
+
+        return tokens
+
+
 DEFAULT_MESSAGE = 'message.html.jst'
+ASSET_MANIFEST = 'assets.json'
+DEFAULT_MANIFEST = '.manifest.json'
 DEFAULT_PARTIALS = 'partials'
 DEFAULT_TEMPLATES = Path('data/templates', pkg_resource=True)
 
+# the templates of the index pages (see ``index_pages``)
+INDEX_TEMPLATES = ('grouped-index.html.jst', 'index.html.jst',
+                   'pages.html.jst', 'thread-index.html.jst')
+
+# the ``--paginate`` pages of the groups not starting with a letter and of
+# the undated messages (listed last)
+OTHER_PAGE = 'other'
+UNDATED_PAGE = 'undated'
+
 
 class PartialManager(dict):
     '''
@@ -154,8 +241,444 @@ class PartialManager(dict):
             raise KeyError(repr(key))
 
 
+class ConnectionPool(object):
+    '''
+    keeps one HTTP(S) connection per host and thread so consecutive requests
+    reuse it (other schemes and proxied hosts, see ``http_proxy`` and
+    ``https_proxy``, fall back to ``urlopen``)
+    '''
+
+    def __init__(self, timeout=HTTP_TIMEOUT):
+        self.__local = threading.local()
+        self.timeout = timeout
+
+    def connection(self, scheme, netloc):
+        'returns the connection of the current thread to a host'
+
+        try:
+            connections = self.__local.connections
+        except AttributeError:
+            connections = self.__local.connections = {}
+
+        try:
+            return connections[scheme, netloc]
+        except KeyError:
+            factory = HTTPSConnection if scheme == 'https' else HTTPConnection
+            result = connections[scheme, netloc] = \
+                factory(netloc, timeout=self.timeout)
+
+            return result
+
+    def open(self, url, redirects=5):
+        'returns a response file object for the url'
+
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or \
+           (parts.scheme in getproxies() and
+            not proxy_bypass(parts.hostname or '')):
+            return urlopen(url)
+
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+
+        connection = self.connection(parts.scheme, parts.netloc)
+        try:
+            connection.request('GET', target)
+            response = connection.getresponse()
+
+        # the server may have closed the idle connection (or the last
+        # response was not read completely), retry once on a new one
+        except (HTTPException, socket.error):
+            connection.close()
+            connection.request('GET', target)
+            response = connection.getresponse()
+
+        if response.status in REDIRECTS and redirects:
+            response.read()
+            return self.open(urljoin(url, response.getheader('Location')),
+                             redirects=redirects - 1)
+
+        if response.status != 200:
+            response.read()
+            raise IOError('unable to fetch %s: %d %s'
+                              % (url, response.status, response.reason))
+
+        return response
+
+
+class Output(object):
+    '''
+    a file written by an ``OutputWriter`` (text is encoded as UTF-8)
+
+    The content is kept in memory, or in a staged file once it is larger than
+    ``BYTES_PER_BATCH``, and handed to the writer when it is closed.
+    '''
+
+    def __init__(self, writer, filename):
+        self.filename = filename
+        self.writer = writer
+
+        self.file = BytesIO()
+        self.size = 0
+        self.staged = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.staged is not None:
+            self.file.close()
+
+        if type is None:
+            self.writer.queue(self)
+        elif self.staged is not None:
+            remove(self.staged)
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+
+        self.size += len(data)
+        if self.staged is None and self.size > BYTES_PER_BATCH:
+            self.staged, file = self.writer.stage()
+            file.write(self.file.getvalue())
+            self.file = file
+
+        self.file.write(data)
+
+
+class OutputWriter(object):
+    '''
+    writes the output files of a stage on a pool of threads and publishes
+    them when the stage is done
+
+    Files are opened with ``open`` and handed to the pool in batches when
+    they are closed. Only the files whose bytes changed are written (to the
+    writer's own directory in the staging directory, along with their
+    ``--precompress`` copies), and they are renamed into place together when
+    the writer is closed, so a stage never shows half written files. The
+    files and bytes written are reported given the name of the stage.
+    '''
+
+    def __init__(self, args, name=None):
+        formats = getattr(args, 'precompress', None) or []
+        if isinstance(formats, basestring):
+            formats = precompress_formats(formats)
+
+        self.formats = formats
+        self.name = name
+        self.shared = path.join(args.output, STAGING_DIRECTORY)
+        self.staging = None
+
+        self.lock = threading.Lock()
+        self.stats = NS(bytes=0, files=0, unchanged=0)
+
+        workers = max(1, getattr(args, 'jobs', 1))
+        self.pool = ThreadPool(workers)
+        self.slots = threading.BoundedSemaphore(2 * workers)
+
+        self.batch = []
+        self.batch_size = 0
+        self.removed = []
+        self.results = []
+        self.written = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        try:
+            if type is None:
+                self.flush()
+
+            self.pool.close()
+            self.pool.join()
+
+            if type is None:
+                for result in self.results:
+                    result.get()
+
+                self.publish()
+        finally:
+            for output in self.batch:
+                if output.staged is not None:
+                    remove(output.staged)
+
+            for staged, _, _ in self.written:
+                remove_output(staged)
+
+            # only this writer's directory, the others may still be staging
+            if self.staging is not None:
+                shutil.rmtree(self.staging, ignore_errors=True)
+
+            try:
+                rmdir(self.shared)
+            except OSError:
+                pass # used by another writer
+
+    def _write(self, batch):
+        try:
+            for output in batch:
+                self._write_output(output)
+        finally:
+            self.slots.release()
+
+    def _write_output(self, output):
+        staged, target = output.staged, output.filename
+
+        if staged is None:
+            data = output.file.getvalue()
+            if not _same_content(target, data):
+                staged, file = self.stage()
+                with file:
+                    file.write(data)
+
+        elif path.exists(target) and cmp(staged, target, shallow=False):
+            remove(staged)
+            staged = None
+
+        if self.formats:
+            precompress(target if staged is None else staged, self.formats)
+
+        with self.lock:
+            if staged is None:
+                self.stats.unchanged += 1
+            else:
+                self.written.append((staged, target, output.size))
+
+    def flush(self):
+        'hands the current batch to the pool'
+
+        if not self.batch:
+            return
+
+        batch, self.batch, self.batch_size = self.batch, [], 0
+
+        self.slots.acquire()
+        self.results.append(self.pool.apply_async(self._write, (batch,)))
+
+    def keep(self, filename):
+        '''
+        keeps a file written by an earlier build (its compressed copies are
+        written if they are out of date)
+        '''
+
+        with self.lock:
+            self.stats.unchanged += 1
+
+        if self.formats:
+            self.results.append(self.pool.apply_async(precompress,
+                                                      (filename,
+                                                       self.formats)))
+
+    def merge(self, stats):
+        'adds the stats of another writer (e.g. of another process)'
+
+        for key, value in stats.items():
+            self.stats[key] += value
+
+    def open(self, filename):
+        'returns an ``Output`` written to ``filename``'
+
+        return Output(self, filename)
+
+    def publish(self):
+        '''
+        renames the written files (and their compressed copies) into place,
+        removes the files given to ``remove`` and reports the stage
+        '''
+
+        suffixes = [PRECOMPRESSORS[name][0] for name in self.formats]
+
+        written, self.written = self.written, []
+        for staged, target, size in written:
+            for suffix in suffixes:
+                rename(staged + suffix, target + suffix)
+
+            rename(staged, target)
+
+            self.stats.files += 1
+            self.stats.bytes += size
+
+        for filename in self.removed:
+            remove_output(filename)
+
+        if self.name is not None:
+            sys.stderr.write('%s: wrote %d file(s) (%d bytes), %d '
+                             'unchanged\n' % (self.name, self.stats.files,
+                                              self.stats.bytes,
+                                              self.stats.unchanged))
+
+    def queue(self, output):
+        'queues a closed ``Output`` (see ``open``)'
+
+        self.batch.append(output)
+        self.batch_size += output.size
+
+        if len(self.batch) >= FILES_PER_BATCH or \
+           self.batch_size >= BYTES_PER_BATCH:
+            self.flush()
+
+    def remove(self, filename):
+        'removes an output file (and its compressed copies) when publishing'
+
+        self.removed.append(filename)
+
+    def stage(self):
+        'returns the name and binary file of a new staged file'
+
+        with self.lock:
+            while self.staging is None:
+                try:
+                    makedirs(self.shared)
+                except OSError:
+                    pass # made by another writer
+
+                try:
+                    self.staging = mkdtemp(dir=self.shared)
+                except OSError as e:
+                    # removed by another writer which was done
+                    if e.errno != errno.ENOENT:
+                        raise
+
+        descriptor, filename = mkstemp(dir=self.staging, suffix='.tmp')
+        chmod(filename, FILE_MODE)
+        return filename, fdopen(descriptor, 'wb')
+
+
+class SortKeys(object):
+    '''
+    the sort keys of a list of messages as a table shared by the partitioners
+    of the indices (see ``make_partitioner``)
+
+    Each header a partitioner sorts or groups on becomes a column of the
+    ranks of its values, made once (all string comparisons are case and
+    whitespace insensitive), so the messages are sorted and grouped on
+    integers.
+    '''
+
+    def __init__(self, messages):
+        self.columns = {}
+        self.messages = messages
+
+    def column(self, name):
+        'returns the ranks of the values of a header'
+
+        try:
+            return self.columns[name]
+        except KeyError:
+            pass
+
+        values = [message['headers'][name] for message in self.messages]
+
+        # each distinct value is only normalized and ranked once
+        keys = {}
+        for value in set(values):
+            keys[value] = ' '.join(value.lower().split()) \
+                          if isinstance(value, basestring) else value
+
+        ranks = dict((key, rank)
+                     for rank, key in enumerate(sorted(set(keys.values()))))
+        for value, key in keys.items():
+            keys[value] = ranks[key]
+
+        column = self.columns[name] = [keys[value] for value in values]
+        return column
+
+    def key(self, names):
+        'returns the ranks of the values of several headers, in order'
+
+        key = self.column(names[0])
+        for name in names[1:]:
+            column = self.column(name)
+            size = max(column) + 1 if column else 1
+            key = [rank * size + other for rank, other in zip(key, column)]
+
+        return key
+
+    def order(self, names):
+        '''
+        returns the positions of the messages sorted on the given headers (the
+        sort is stable)
+        '''
+
+        key = self.key(names)
+        return sorted(range(len(key)), key=key.__getitem__)
+
+
+CONNECTIONS = ConnectionPool()
+
+# the options and message template of a build process (see ``run_build``)
+BUILD = NS()
+
+
+def _gunzip(data):
+    with GzipFile(fileobj=BytesIO(data)) as file:
+        return file.read()
+
+
+def _gzip(data):
+    # without a timestamp, the same content always compresses the same
+    buffer = BytesIO()
+    with GzipFile(filename='', mode='wb', compresslevel=9, fileobj=buffer,
+                  mtime=0) as file:
+        file.write(data)
+
+    return buffer.getvalue()
+
+
+def _init_build(args, pages, locations):
+    'prepares a build process (the template is only compiled once)'
+
+    BUILD.args = args
+    BUILD.locations = locations
+    BUILD.pages = pages
+    BUILD.template = load_message_template(args)
+    BUILD.version = template_version(args)
+
+
+def _render_chunk(chunk):
+    '''
+    writes the message pages of a chunk (see ``message_chunks``) and returns
+    their digests and the stats of the writer
+    '''
+
+    threads, back, forward = chunk
+    with OutputWriter(BUILD.args) as writer:
+        pages = render_messages(threads, BUILD.args, writer,
+                                template=BUILD.template, back=back,
+                                forward=forward, pages=BUILD.pages,
+                                version=BUILD.version,
+                                locations=BUILD.locations)
+
+    return pages, writer.stats
+
+
+def _run_static():
+    'writes the static files in a build process'
+
+    run_static(BUILD.args)
+
+
+def _same_content(filename, data):
+    'returns whether a file exists with the given content'
+
+    try:
+        if path.getsize(filename) != len(data):
+            return False
+
+        with open(filename, 'rb') as file:
+            return file.read() == data
+    except (IOError, OSError):
+        return False
+
+
 def Template(*args, **kargs):
-    'create a Template with our preferred defaults'
+    '''
+    create a Template with our preferred defaults (compiled to Python, see
+    ``compile_template``)
+    '''
 
     meta = kargs.pop('meta', '{{}}')
     formatters = kargs.pop('more_formatters', None)
@@ -171,38 +694,361 @@ def Template(*args, **kargs):
     else:
         kargs['more_formatters'] = DEFAULT_FORMATTERS
 
-    return jsontemplate.Template(*args, meta=meta, **kargs)
+    return compile_template(*args, meta=meta, **kargs)
+
+
+# the key of the static files in the ``assets`` of the templates, their
+# filename and the package resources they are made of (templates.json is
+# made of the partials and has to come before messages.js, which fetches it)
+ASSETS = [
+    ('history_js', 'history.js', ['data/scripts/history.js',
+                                  'data/scripts/history.adapter.jquery.js']),
+    ('jquery_js', 'jquery-1.7.2.min.js',
+        ['data/scripts/jquery-1.7.2.min.js']),
+    ('json_template_js', 'json-template.js',
+        ['data/scripts/json-template.js']),
+    ('messages_css', 'messages.css', ['data/styles/messages.css']),
+    ('templates_json', 'templates.json', []),
+    ('messages_js', 'messages.js', ['data/scripts/messages.js.jst']),
+]
 
 
-def convert(url, gzip=False):
-    'converts a mbox url to a JSON encodable structure'
+def asset_names(args):
+    '''
+    returns the names of the static files by their key (see ``ASSETS``),
+    which are fingerprinted with ``--fingerprint``
+    '''
 
-    parser = parse_gz_mbox if gzip else parse_mbox
+    if not getattr(args, 'fingerprint', False):
+        return dict((key, filename) for key, filename, _ in ASSETS)
 
-    # stdin
-    if url == '-':
-        messages = parser(fileobj=BytesIO(sys.stdin.read()))
+    return dict((key, name) for key, _, name, _ in static_files(args))
 
-    # local file
-    elif not urlsplit(url).scheme:
-        messages = parser(filename=url)
+
+def convert(urls, gzip=False, jobs=1, workers=4, headers=DEFAULT_HEADERS,
+            dedupe=None, threading='in-reply-to'):
+    '''
+    converts mbox urls to a JSON encodable structure (see ``expand_inputs``
+    for the accepted urls) keeping only the ``headers`` of each message
+
+    Multiple inputs are fetched, decompressed and parsed by ``workers``
+    threads and threaded together. A single uncompressed local file is
+    parsed by ``jobs`` processes instead. Given a ``Deduplicator`` only the
+    first of the messages sharing a Message-Id is kept. ``threading`` names
+    the threading engine (see ``THREADERS``).
+    '''
+
+    if isinstance(urls, basestring):
+        urls = [urls]
+
+    inputs = expand_inputs(urls, gzip=gzip)
+    if len(inputs) == 1:
+        messages = read_input(inputs[0], jobs=jobs, headers=headers,
+                              dedupe=dedupe)
     else:
-        messages = fetch_messages(url, parser=parser)
+        # the inputs are read concurrently, they claim the hashes while
+        # parsing (the result does not depend on the order the inputs finish
+        # in) and the copies claimed by a later input first are dropped here
+        def read(position):
+            return list(read_input(inputs[position], headers=headers,
+                                   dedupe=dedupe, position=position))
+
+        pool = ThreadPool(max(1, min(workers, len(inputs))))
+        try:
+            messages = [message for messages in
+                        pool.imap(read, range(len(inputs)))
+                        for message in messages]
+        finally:
+            pool.terminate()
+
+        if dedupe is not None:
+            messages = [m for m in messages
+                        if not m.headers.get('message_id_hash')
+                        or dedupe.add(m.headers.message_id_hash)]
+
+    return thread_messages(messages, threading=threading)
+
+
+def convert_incremental(urls, output, gzip=False, jobs=1, workers=4,
+                        headers=DEFAULT_HEADERS, dedupe=None,
+                        threading='in-reply-to'):
+    '''
+    like ``convert``, but only the messages appended to the inputs since the
+    run which wrote ``output`` are parsed and threaded (with the threads of
+    ``output``, loaded in a ``ThreadGraph``)
+
+    Returns the threads and the state to save (see ``save_state``) once
+    ``output`` has been written. Everything is parsed again if an input was
+    rewritten instead of appended to, or the inputs, headers or threading
+    engine changed.
+    '''
+
+    if isinstance(urls, basestring):
+        urls = [urls]
+
+    inputs = [i.url for i in expand_inputs(urls, gzip=gzip)]
+    for url in inputs:
+        if url == '-' or urlsplit(url).scheme or url.endswith('.gz') or gzip:
+            raise ValueError('incremental conversion requires uncompressed '
+                             'local mbox files: %s' % url)
+
+    headers = None if headers is None else list(headers)
+    previous = load_json(output + STATE_SUFFIX)
+    state = dict(headers=headers, inputs={}, threading=threading)
+
+    appended = previous is not None and previous.headers == headers and \
+               previous.get('threading') == threading and \
+               set(previous.inputs) == set(inputs)
+
+    for url in inputs:
+        size = path.getsize(url)
+        offset = previous.inputs[url].offset if appended else 0
+
+        if offset > size:
+            appended = False
+            checksum, = prefix_checksums(url, [size])
+        else:
+            old, checksum = prefix_checksums(url, [offset, size])
+            appended = appended and old == previous.inputs[url].checksum
+
+        # appended messages start right where the last run stopped
+        if appended and offset < size:
+            with open(url, 'rb') as file:
+                file.seek(offset)
+                appended = file.read(len(FROM_LINE)) == FROM_LINE
+
+        state['inputs'][url] = dict(offset=size, checksum=checksum)
+
+    graph = None
+    if appended:
+        graph = ThreadGraph.load(output, threading=threading)
+
+    if graph is None:
+        appended = False
+        graph = ThreadGraph(threading)
+
+    # the kept messages drop their duplicates appended since
+    if dedupe is not None:
+        for message in graph.messages():
+            if message.headers.get('message_id_hash'):
+                dedupe.remember(message.headers.message_id_hash)
+
+    messages = []
+    for url in inputs:
+        messages.extend(parse_mbox(
+            filename=url, jobs=jobs, headers=headers, dedupe=dedupe,
+            offset=previous.inputs[url].offset if appended else 0,
+            stop=state['inputs'][url]['offset'],
+        ))
+
+    graph.add(messages)
+    return graph.flatten(), state
+
+
+def expand_inputs(urls, gzip=False):
+    '''
+    returns the mbox files to read as ``NS(url=..., gzip=...)``
+
+    A url can be ``-`` (stdin), a filename or glob, a URL to a mbox file or a
+    pipermail listing page (a URL ending in ``/`` or ``.html``) whose
+    ``*.txt.gz`` archives are used. Files ending in ``.gz`` are always
+    decompressed. A ValueError is raised for a url which expands to nothing
+    (the scripts report it as a bad argument).
+    '''
+
+    result = []
+    for url in urls:
+        if url == '-':
+            found = [url]
+        elif not urlsplit(url).scheme:
+            found = sorted(glob(url)) if has_magic(url) else [url]
+        elif urlsplit(url).path.endswith(('/', '.html')):
+            found = find_archives(url)
+        else:
+            found = [url]
+
+        # a mistyped glob must not become an empty archive
+        if not found:
+            raise ValueError('no input found for %s' % url)
 
-    threads = list(normalize_threads(build_threads(list(messages))))
-    tie_threads(threads)
+        result.extend(NS(url=u, gzip=gzip or u.endswith('.gz'))
+                      for u in found)
 
-    return list(flatten_threads(threads))
+    return result
 
 
 def fetch_messages(url, parser=parse_mbox):
     'parse messages via a URL'
 
-    with closing(urlopen(url)) as network_file:
-        for message in parser(fileobj=BytesIO(network_file.read())):
+    with closing(CONNECTIONS.open(url)) as network_file:
+        for message in parser(fileobj=network_file):
             yield message
 
 
+def find_archives(url):
+    'returns the URLs of the gzipped archives linked from a listing page'
+
+    with closing(CONNECTIONS.open(url)) as page:
+        html = page.read().decode('utf-8', 'replace')
+
+    result = []
+    for link in ARCHIVE_PATTERN.findall(html):
+        link = urljoin(url, link)
+        if link not in result: result.append(link)
+
+    return result
+
+
+def index_digest(template, data, version, author_page):
+    '''
+    returns the digest of everything an index page is rendered from (the
+    headers of its messages and their ``author_page``, see ``index_pages``)
+    '''
+
+    def entry(message):
+        return [message['headers'], author_page(message)]
+
+    if template == 'pages.html.jst':
+        entries = data['pages']
+    elif 'groups' in data:
+        entries = [[group['name'], [entry(m) for m in group['messages']]]
+                   for group in data['groups']]
+    elif 'messages' in data:
+        entries = [entry(message) for message in data['messages']]
+    else:
+        # the threads in depth first order with the depth of their messages
+        entries = []
+        stack = [(0, thread) for thread in reversed(data['threads'])]
+        while stack:
+            depth, thread = stack.pop()
+            entries.append([depth] + entry(thread.message))
+            stack.extend((depth + 1, child)
+                         for child in reversed(thread.children))
+
+    data = json.dumps([version, data['title'], data.get('page'), entries],
+                      sort_keys=True, default=json_default)
+
+    return sha1(data.encode('utf-8')).hexdigest()
+
+
+def index_pages(threads, args):
+    '''
+    returns the pages of the indices and the index pages of the messages
+
+    The pages are ``(filename, template, data)`` triples (``template`` is one
+    of ``INDEX_TEMPLATES``), the thread index data has the threads (see
+    ``run_indices``). With ``--paginate`` every index is a navigation page
+    and its pages (see ``paginate``) and the filenames of the pages of every
+    message are returned by ``message_id_hash`` (as the index links of its
+    message page, see ``render_messages``), ``None`` otherwise.
+    '''
+
+    size = getattr(args, 'page_size', 0) \
+        if getattr(args, 'paginate', False) else None
+    locations = None if size is None else {}
+    pages = []
+
+    def add_index(filename, title, template, link, key, items, pager,
+                  messages_of, size=0):
+
+        if locations is None:
+            pages.append((filename, template, {'title': title, key: items}))
+            return
+
+        paged = paginate(items, pager, size, messages_of)
+        links = [dict(name=name, filename=page_filename(filename, name))
+                 for name, _ in paged]
+
+        pages.append((filename, 'pages.html.jst', dict(title=title, pages=[
+            dict(links[i], count=sum(len(messages_of(item)) for item in page))
+            for i, (_, page) in enumerate(paged)
+        ])))
+
+        for i, (name, page) in enumerate(paged):
+            pages.append((links[i]['filename'], template, {
+                'title': '%s: %s' % (title, name),
+                'page': dict(
+                    index=filename,
+                    previous=links[i - 1] if i > 0 else None,
+                    next=links[i + 1] if i + 1 < len(links) else None,
+                ),
+                key: page,
+            }))
+
+            for item in page:
+                for message in messages_of(item):
+                    hash = message['headers']['message_id_hash']
+                    locations.setdefault(hash, {})[link] = \
+                        links[i]['filename']
+
+    # the messages of the indices (with their author page, set below)
+    indexed = [
+        NS([('from', simple_from(m['headers']['from']))] + list(m.items()))
+        for _, messages in threads
+            for m in messages
+    ]
+
+    keys = SortKeys(indexed)
+    for index in INDICES:
+        data = index.partitioner(indexed, keys)
+        if 'groups' in data:
+            add_index(index.filename(args), index.name(args),
+                      'grouped-index.html.jst', index.link, 'groups',
+                      data['groups'], index.pager,
+                      lambda group: group['messages'], size)
+        else:
+            add_index(index.filename(args), index.name(args),
+                      'index.html.jst', index.link, 'messages',
+                      data['messages'], index.pager,
+                      lambda message: [message])
+
+    # the threads are rebuilt from their flattened form, JSON converted before
+    # the parents were kept has to be threaded again
+    if all('parents' in top for top, _ in threads):
+        forest = [unflatten_thread(top, messages)
+                  for top, messages in threads]
+    else:
+        forest = list(THREADERS[args.threading](
+            [message for _, messages in threads for message in messages]
+        ))
+
+    add_index(args.thread_index, args.thread_title, 'thread-index.html.jst',
+              'thread_index', 'threads', forest,
+              lambda thread: month_page(
+                  first_message(thread).headers.date_utc),
+              lambda thread: list(walk_thread(thread)))
+
+    for message in indexed:
+        message.author_page = location(locations, message, 'author_index',
+                                       args)
+
+    return NS(pages=pages, locations=locations)
+
+
+def kept_headers(names):
+    '''
+    returns the headers to keep given the extra header names from the
+    command line (``*`` keeps all of them)
+    '''
+
+    if not names:
+        return DEFAULT_HEADERS
+
+    if '*' in names:
+        return None
+
+    extra = [header_name(name) for name in names]
+    return DEFAULT_HEADERS + tuple(n for n in extra
+                                   if n not in DEFAULT_HEADERS)
+
+
+def letter_page(name):
+    'returns the ``--paginate`` page of a group (its first letter)'
+
+    letter = (name or '').strip()[:1].lower()
+    return letter if letter and letter in ascii_lowercase else OTHER_PAGE
+
+
 def load_template(filename, **kargs):
     'create a template by filename'
 
@@ -213,33 +1059,72 @@ def load_template(filename, **kargs):
         return Template(file.read(), **kargs)
 
 
-def make_partitioner(sort_keys, group_keys=None):
-    'returns a method to partition a sequence of messages'
+def load_json(filename):
+    'returns the wrapped contents of a JSON file (``None`` if it is missing)'
+
+    try:
+        with open(filename, 'rb') as file:
+            return wrap_dictionaries(json.loads(file.read().decode('utf-8')))
+    except (IOError, ValueError):
+        return None
+
+
+def load_manifest(args, key='pages'):
+    '''
+    returns the digests of the message pages (or the index pages, given
+    "indices") of the last build (see ``render_messages`` and
+    ``run_indices``), nothing if ``--force`` is given
+    '''
+
+    manifest = None
+    if not getattr(args, 'force', False):
+        manifest = load_json(path.join(args.output, DEFAULT_MANIFEST))
+
+    return dict(manifest.get(key, {})) if manifest else {}
+
+
+def location(locations, message, link, args):
+    '''
+    returns the filename of the index page (``link`` is the option of the
+    index, e.g. "date_index") of a message (see ``index_pages``)
+    '''
+
+    if locations:
+        hash = message['headers'].get('message_id_hash')
+        return locations.get(hash, {}).get(link, getattr(args, link))
+
+    return getattr(args, link)
+
+
+def load_message_template(args):
+    'create the message template (with the partials)'
+
+    partials = {}
+    if args.partials.isdir():
+        partials = PartialManager(args.partials)
 
-    def key(keys):
-        def key(message):
-            headers = message['headers']
-            for key in keys:
-                header = headers[key]
+    return load_template(args.message_template, more_formatters=partials)
 
-                # all string comparisons are case and whitespace insensitive
-                if isinstance(header, basestring):
-                    yield ' '.join(header.lower().split())
-                else:
-                    yield header
 
-        return lambda message: tuple(key(message))
+def make_partitioner(sort_keys, group_keys=None):
+    '''
+    returns a method to partition a sequence of messages (given their
+    ``SortKeys``, which are shared by the indices, or made for them)
+    '''
+
+    def partitioner(messages, keys=None):
+        if keys is None:
+            keys = SortKeys(list(messages))
 
-    sort_key = key(sort_keys)
-    group_key = key(group_keys)
+        messages = keys.messages
+        order = keys.order(sort_keys)
 
-    def partitioner(messages):
         if not group_keys:
-            return dict(messages=sorted(messages, key=sort_key))
+            return dict(messages=[messages[i] for i in order])
         else:
             # do not use the groupby key because it has been normalized
-            groups = (list(messages) for _, messages in
-                      groupby(sorted(messages, key=sort_key), key=group_key))
+            groups = ([messages[i] for i in positions] for _, positions in
+                      groupby(order, key=keys.key(group_keys).__getitem__))
 
             return dict(groups=[dict(name=m[0]['headers'][group_keys[0]],
                                      messages=m) for m in groups])
@@ -251,37 +1136,215 @@ def map_thread(fn, thread):
     'maps messages in a thread given a mapping function ``fn``'
 
     children = []
-    result = NS(message=fn(thread.message), children=children)
+    result = Node(message=fn(thread.message), children=children)
 
     queue = deque([(thread.children, children)])
     while queue:
         parents, lst = queue.popleft()
         for parent in parents:
             children = []
-            lst.append(NS(message=fn(parent.message), children=children))
+            lst.append(Node(message=fn(parent.message), children=children))
             queue.append((parent.children, children))
 
     return result
 
 
-def parse_gz_mbox(filename=None, fileobj=None):
-    'parse a gz compressed mbox file'
+def message_chunks(threads, size=MESSAGES_PER_CHUNK):
+    '''
+    splits the threads into chunks of about ``size`` messages and yields
+    them as ``(threads, back, forward)`` (see ``render_messages``)
+    '''
+
+    start = count = 0
+    for stop, (_, messages) in enumerate(threads, 1):
+        count += len(messages)
+        if count < size and stop < len(threads): continue
+
+        back = paging_info(threads[start - 1][1][0]) if start else None
+        forward = paging_info(threads[stop][1][0]) \
+                  if stop < len(threads) else None
+
+        yield threads[start:stop], back, forward
+        start, count = stop, 0
+
+
+def month_page(date):
+    'returns the ``--paginate`` page of a date (its year and month)'
+
+    if date is None:
+        return UNDATED_PAGE
+
+    return strftime('%Y-%m', gmtime(date))
+
+
+def page_digest(message, back, forward, version, links):
+    'returns the digest of everything a message page is rendered from'
+
+    data = json.dumps([message, back, forward, version, links],
+                      sort_keys=True, default=json_default)
+
+    return sha1(data.encode('utf-8')).hexdigest()
+
+
+def page_filename(filename, name):
+    'returns the filename of a page of an index ("date-2012-04.html")'
+
+    root, extension = path.splitext(filename)
+    return '%s-%s%s' % (root, name, extension)
+
+
+def paginate(items, pager, size=0, messages_of=None):
+    '''
+    splits the items of an index into ``(name, items)`` pages, by the page
+    ``pager`` returns for an item or, given a ``size``, in order into
+    numbered pages of at least ``size`` messages (``messages_of`` returns
+    the messages of an item, an item is never split)
+    '''
+
+    if not size:
+        pages = {}
+        for item in items:
+            pages.setdefault(pager(item), []).append(item)
+
+        return sorted(pages.items(), key=lambda page: (
+            page[0] in (OTHER_PAGE, UNDATED_PAGE), page[0]))
+
+    pages = [[]]
+    count = 0
+    for item in items:
+        if count >= size:
+            pages.append([])
+            count = 0
+
+        pages[-1].append(item)
+        count += len(messages_of(item))
+
+    return [('%d' % number, page)
+            for number, page in enumerate(pages, 1) if page]
+
+
+def parse_gz_mbox(filename=None, fileobj=None, **kargs):
+    'parse a gz compressed mbox file (see ``parse_mbox`` for the options)'
 
     if not filename and not fileobj:
         raise ValueError('one of "filename" or "fileobj" is required')
 
     gz = GzipFile(filename=filename, fileobj=fileobj)
-    for message in parse_mbox(fileobj=gz):
+    for message in parse_mbox(fileobj=gz, **kargs):
         yield message
 
 
+# the suffix, compressor and decompressor of the ``--precompress`` formats
+PRECOMPRESSORS = {
+    'br': ('.br', lambda data: brotli.compress(data),
+           lambda data: brotli.decompress(data)),
+    'gzip': ('.gz', _gzip, _gunzip),
+}
+
+def precompress(filename, formats):
+    '''
+    writes the compressed copies of a file (``filename`` + the suffix of each
+    of the ``PRECOMPRESSORS`` formats) which are out of date
+
+    A copy newer than the file is up to date, as is an older one which
+    decompresses to the same content (which is only touched, so a file
+    written again with the same content is not compressed again).
+    '''
+
+    modified = path.getmtime(filename)
+    data = None
+
+    for name in formats:
+        suffix, compress, decompress = PRECOMPRESSORS[name]
+        target = filename + suffix
+
+        try:
+            if path.getmtime(target) > modified: continue
+        except OSError:
+            pass
+
+        if data is None:
+            with open(filename, 'rb') as file:
+                data = file.read()
+
+        # a missing or corrupt copy is written again
+        try:
+            with open(target, 'rb') as file:
+                if decompress(file.read()) == data:
+                    utime(target, None)
+                    continue
+        except Exception:
+            pass
+
+        directory, basename = path.split(target)
+        with NamedTemporaryFile(dir=directory, prefix='.' + basename,
+                                suffix='.tmp', delete=False) as file:
+            file.write(compress(data))
+
+        try:
+            chmod(file.name, FILE_MODE)
+            rename(file.name, target)
+        except OSError:
+            remove(file.name)
+            raise
+
+
+def precompress_formats(value):
+    '''
+    parses the comma separated formats of ``--precompress`` (see
+    ``PRECOMPRESSORS``)
+    '''
+
+    formats = [name.strip() for name in value.split(',') if name.strip()]
+    for name in formats:
+        if name not in PRECOMPRESSORS:
+            choices = ', '.join(sorted(PRECOMPRESSORS))
+            raise ArgumentTypeError('unknown format %r (choose from %s)'
+                                    % (name, choices))
+
+        if name == 'br' and brotli is None:
+            raise ArgumentTypeError('"br" needs the brotli package')
+
+    return formats
+
+
 def preprocess_messages(args):
     'fetches or loads the threads needed for message related activities'
 
-    url = args.url
-    if not args.json:
+    urls = args.urls
+    url = urls[0]
+    if (args.index or args.json) and len(urls) > 1:
+        mailarchive_parser.error('--%s requires a single url'
+                                     % ('index' if args.index else 'json'))
+
+    args.deduplicator = Deduplicator() if args.dedupe else None
+
+    args.mbox_index = None
+    if args.index:
+        if args.json or args.gzip or url == '-' or urlsplit(url).scheme:
+            mailarchive_parser.error('--index requires an uncompressed '
+                                     'local mbox file')
+
+        # only the headers are loaded, payloads are read when rendering
+        args.mbox_index = MboxIndex.load(url)
+        if args.mbox_index.skipped:
+            sys.stderr.write('skipped %d message(s) without a Message-Id\n'
+                             % args.mbox_index.skipped)
+
+        threads = thread_messages(args.mbox_index.messages(
+            headers=kept_headers(args.headers), dedupe=args.deduplicator
+        ), threading=args.threading)
+
+    elif not args.json:
         # run convert (and all its logic)
-        threads = convert(args.url, gzip=args.gzip)
+        try:
+            threads = convert(urls, gzip=args.gzip, jobs=args.jobs,
+                              workers=args.workers,
+                              headers=kept_headers(args.headers),
+                              dedupe=args.deduplicator,
+                              threading=args.threading)
+        except ValueError as e:
+            mailarchive_parser.error(str(e))
     else:
         # stdin
         if url == '-':
@@ -297,6 +1360,11 @@ def preprocess_messages(args):
 
         threads = wrap_dictionaries(json.loads(data))
 
+    # stopped before anything is written, an empty build would leave the
+    # pages of the last one out of every index (or remove them)
+    if not threads:
+        mailarchive_parser.error('no messages found in %s' % ', '.join(urls))
+
     if args.templates is None:
         args.templates = DEFAULT_TEMPLATES
 
@@ -306,15 +1374,167 @@ def preprocess_messages(args):
     if args.message_template is None:
         args.message_template = args.templates + DEFAULT_MESSAGE
 
+    args.assets = asset_names(args)
+
     return dict(threads=threads, args=args)
 
 
+def read_input(source, jobs=1, headers=DEFAULT_HEADERS, dedupe=None,
+               position=None):
+    '''
+    parses the messages of an input returned by ``expand_inputs`` (see
+    ``parse_mbox`` for the options)
+    '''
+
+    url = source.url
+    parser = partial(parse_gz_mbox if source.gzip else parse_mbox,
+                     headers=headers, dedupe=dedupe, position=position)
+
+    # stdin
+    if url == '-':
+        messages = parser(fileobj=getattr(sys.stdin, 'buffer', sys.stdin))
+
+    # local file
+    elif not urlsplit(url).scheme:
+        if source.gzip:
+            messages = parser(filename=url)
+        else:
+            messages = parser(filename=url, jobs=jobs)
+    else:
+        messages = fetch_messages(url, parser=parser)
+
+    for message in messages:
+        yield message
+
+
+def remove_output(filename):
+    'removes an output file and its compressed copies (see ``precompress``)'
+
+    for name in [filename] + [filename + suffix
+                              for suffix, _, _ in PRECOMPRESSORS.values()]:
+        try:
+            remove(name)
+        except OSError:
+            pass
+
+
+def render_messages(threads, args, writer, template=None, back=None,
+                    forward=None, pages=None, version=None, locations=None):
+    '''
+    writes the message pages of a sequence of threads with an
+    ``OutputWriter``, ``back`` and ``forward`` are the paging info of the
+    threads before and after them and ``locations`` the index pages of the
+    messages with ``--paginate`` (see ``index_pages``)
+
+    Returns the digests of the pages (see ``page_digest``) by
+    ``message_id_hash``. Pages whose digest is the same in ``pages`` (the
+    digests of the last build) are not written again.
+    '''
+
+    mbox_index = getattr(args, 'mbox_index', None)
+    load_payload = mbox_index.load_payload if mbox_index else \
+                   lambda message: message
+
+    if template is None:
+        template = load_message_template(args)
+
+    if version is None:
+        version = template_version(args)
+
+    pages = pages or {}
+    digests = {}
+
+    for index in range(len(threads)):
+        if index > 0:
+            back = paging_info(threads[index - 1][1][0])
+
+        try:
+            after = paging_info(threads[index + 1][1][0])
+        except IndexError:
+            after = forward
+
+        for message in threads[index][1]:
+            message = load_payload(message)
+            hash = message.headers.message_id_hash
+            filename = path.join(args.output, hash + '.html')
+
+            links = dict((link, location(locations, message, link, args))
+                         for link in ('author_index', 'date_index',
+                                      'subject_index', 'thread_index'))
+
+            digest = digests[hash] = page_digest(message, back, after,
+                                                 version, links)
+            if pages.get(hash) == digest and path.exists(filename):
+                writer.keep(filename)
+                continue
+
+            with writer.open(filename) as out:
+                stream_template(template, dict(
+                    list_address=args.list_address,
+                    title=args.page_title,
+                    top_level=args.page_link,
+                    web_root=args.web_root,
+                    assets=args.assets,
+
+                    template=template,
+                    message=message,
+                    next_thread=after,
+                    previous_thread=back,
+
+                    **links
+                ), out)
+
+    return digests
+
+
+def report_duplicates(dedupe):
+    'reports the dropped duplicates'
+
+    sys.stderr.write('dropped %d duplicate message(s)\n' % dedupe.dropped)
+
+
 def run_build(threads, args):
-    'builds the message and index files'
+    '''
+    builds the message and index files
+
+    With more than one job the static files and chunks of message pages are
+    written by a pool of processes while messages.json and the indices are
+    written by this one (each stage writes its own files, so they do not
+    wait for each other).
+    '''
 
-    run_static(args)
-    run_indices(threads, args)
-    run_messages(threads, args)
+    indices = index_pages(threads, args)
+
+    if args.jobs <= 1:
+        run_static(args)
+        run_indices(threads, args, indices)
+        run_messages(threads, args, indices.locations)
+        return
+
+    previous = load_manifest(args)
+    pool = Pool(args.jobs, initializer=_init_build,
+                initargs=(args, previous, indices.locations))
+    try:
+        static = pool.apply_async(_run_static)
+        chunks = [pool.apply_async(_render_chunk, (chunk,))
+                  for chunk in message_chunks(threads)]
+
+        pages = {}
+        with OutputWriter(args, 'messages') as writer:
+            save_messages(threads, args, writer, indices.locations)
+            run_indices(threads, args, indices)
+
+            # raises the errors of the processes
+            static.get()
+
+            for chunk in chunks:
+                digests, stats = chunk.get()
+                pages.update(digests)
+                writer.merge(stats)
+    finally:
+        pool.terminate()
+
+    save_manifest(args, previous, pages)
 
 
 def run_convert():
@@ -322,93 +1542,134 @@ def run_convert():
 
     args = convert_parser.parse_args()
     output = sys.stdout
+    dedupe = Deduplicator() if args.dedupe else None
+
+    kargs = dict(gzip=args.gzip, jobs=args.jobs, workers=args.workers,
+                 headers=kept_headers(args.headers), dedupe=dedupe,
+                 threading=args.threading)
+
+    state = None
+    if args.incremental:
+        if not args.output:
+            convert_parser.error('--incremental requires --output')
+
+        try:
+            threads, state = convert_incremental(
+                args.urls, args.output, **kargs
+            )
+        except ValueError as e:
+            convert_parser.error(str(e))
+    else:
+        try:
+            threads = convert(args.urls, **kargs)
+        except ValueError as e:
+            convert_parser.error(str(e))
 
     try:
         if args.output:
             output = open(args.output, 'wb')
 
 
-        encoder = json.JSONEncoder(ensure_ascii=False, sort_keys=True)
-        for chunk in encoder.iterencode(convert(args.url, gzip=args.gzip)):
+        encoder = json.JSONEncoder(ensure_ascii=False, sort_keys=True,
+                                   default=json_default)
+
+        for chunk in encoder.iterencode(threads):
             output.write(chunk.encode('utf-8'))
 
     finally:
         if output is not sys.stdout: output.close()
 
+    # only saved once the output is complete (an older state only makes the
+    # next run thread some messages again)
+    if state is not None:
+        save_state(args.output + STATE_SUFFIX, state)
+
+    if dedupe is not None:
+        report_duplicates(dedupe)
 
+
+# ``link`` is the option of an index (the field of the index links of the
+# message pages), ``pager`` returns the ``--paginate`` page of a message or
+# a group of messages
 INDICES = [
     NS(name=lambda x: x.date_title, filename=lambda x: x.date_index,
-       partitioner=make_partitioner(['date_utc'])),
+       link='date_index', partitioner=make_partitioner(['date_utc']),
+       pager=lambda message: month_page(message['headers']['date_utc'])),
 
     NS(name=lambda x: x.subject_title, filename=lambda x: x.subject_index,
-       partitioner=make_partitioner(['subject', 'date_utc'], ['subject'])),
+       link='subject_index',
+       partitioner=make_partitioner(['subject', 'date_utc'], ['subject']),
+       pager=lambda group: letter_page(group['name'])),
 
     NS(name=lambda x: x.author_title, filename=lambda x: x.author_index,
-       partitioner=make_partitioner(['from', 'date_utc'], ['from'])),
+       link='author_index',
+       partitioner=make_partitioner(['from', 'date_utc'], ['from']),
+       pager=lambda group: letter_page(simple_from(group['name']))),
 ]
 
 
-def run_indices(threads, args):
-    'builds the index files'
-
-    single_template = load_template(args.templates + 'index.html.jst')
-    grouped_template = load_template(args.templates + 'grouped-index.html.jst')
-
-    messages = [
-        NS([('from', simple_from(m['headers']['from']))] + list(m.items()))
-        for _, messages in threads
-            for m in messages
-    ]
-
-    # build simple indices
-    for index in INDICES:
-        data = dict(title=index.name(args), **index.partitioner(messages))
-
-        if 'groups' in data:
-            html = grouped_template.expand(data)
-        else:
-            html = single_template.expand(data)
-
-        with open(path.join(args.output, index.filename(args)), mode='w',
-                  encoding='utf-8') as out:
+def run_indices(threads, args, indices=None):
+    '''
+    builds the index files (see ``index_pages``), the pages which did not
+    change since the last build are not written again
+    '''
 
-            out.write(html)
+    if indices is None:
+        indices = index_pages(threads, args)
 
+    previous = load_manifest(args, 'indices')
+    version = template_version(args, [args.templates + name
+                                      for name in INDEX_TEMPLATES])
 
     partials = {}
     if args.partials.isdir():
         partials = PartialManager(args.partials)
 
-    index_template = load_template(args.templates + 'thread-index.html.jst',
-                                   more_formatters=partials)
+    templates = dict((name, load_template(args.templates + name,
+                                          more_formatters=partials))
+                     for name in INDEX_TEMPLATES)
 
     partial_template = load_template(args.partials + 'thread.html.jst',
                                      more_formatters=partials)
 
-    # flatten the threads
-    messages = [message for _, messages in threads for message in messages]
+    author_page = lambda message: location(indices.locations, message,
+                                           'author_index', args)
 
     def preprocess(message):
         from_ = simple_from(message.headers.get('from', '')) or None
-        return dict(list(message.items()) + [('from', from_)])
-
-    # recursively render the threads here so the expanding doesn't
-    # hit the recursion limit
-    def render_thread(thread):
-        return partial_template.expand(
-            message=preprocess(thread.message),
-            children=[render_thread(child) for child in thread.children]
-        )
-
-    with open(path.join(args.output, args.thread_index), mode='w',
-              encoding='utf-8') as out:
-
-        out.write(index_template.expand(
-            title=args.thread_title,
-            threads=[dict(message=preprocess(t.message),
-                          children=[render_thread(c) for c in t.children])
-                     for t in normalize_threads(build_threads(messages))]
-        ))
+        return dict(list(message.items()) + [('from', from_),
+                                             ('author_page',
+                                              author_page(message))])
+
+    # the replies are fragments, expanded when they are written (without
+    # recursion, which would hit the recursion limit)
+    def children(thread):
+        return [Fragment(partial_template, partial(thread_data, child))
+                for child in thread.children]
+
+    def thread_data(thread):
+        return dict(message=preprocess(thread.message),
+                    children=children(thread))
+
+    digests = {}
+    with OutputWriter(args, 'indices') as writer:
+        for filename, template, data in indices.pages:
+            digest = digests[filename] = index_digest(template, data,
+                                                      version, author_page)
+
+            target = path.join(args.output, filename)
+            if previous.get(filename) == digest and path.exists(target):
+                writer.keep(target)
+                continue
+
+            if 'threads' in data:
+                data = dict(data, threads=[thread_data(thread)
+                                           for thread in data['threads']])
+
+            with writer.open(target) as out:
+                stream_template(templates[template], data, out)
+
+    save_manifest(args, previous, digests, 'indices')
 
 
 def run_mailarchive():
@@ -456,108 +1717,332 @@ def run_mailarchive():
 
     args.action(**preprocessed)
 
+    # only saved once the output is complete
+    if getattr(args, 'deduplicator', None) is not None:
+        report_duplicates(args.deduplicator)
+
 
-def run_messages(threads, args):
+def run_messages(threads, args, locations=None):
     'builds the message files'
 
-    with open(path.join(args.output, 'messages.json'), 'wb') as out:
-        out.write(json.dumps(threads, ensure_ascii=False).encode('utf-8'))
+    if locations is None and getattr(args, 'paginate', False):
+        locations = index_pages(threads, args).locations
 
-    partials = {}
-    if args.partials.isdir():
-        partials = PartialManager(args.partials)
+    previous = load_manifest(args)
 
-    message_template = load_template(args.message_template,
-                                     more_formatters=partials)
+    with OutputWriter(args, 'messages') as writer:
+        save_messages(threads, args, writer, locations)
+        pages = render_messages(threads, args, writer, pages=previous,
+                                locations=locations)
 
-    back = None
-    for index in range(len(threads)):
-        if index > 0:
-            back = paging_info(threads[index - 1][1][0])
+    save_manifest(args, previous, pages)
 
-        try:
-            forward = paging_info(threads[index + 1][1][0])
-        except IndexError:
-            forward = None
 
-        for message in threads[index][1]:
-            filename = message.headers.message_id_hash + '.html'
-            with open(path.join(args.output, filename), mode='w',
-                      encoding='utf-8') as out:
+def run_static(args):
+    '''
+    writes static files to the specified output directory (and their
+    fingerprinted copies and ``assets.json`` with ``--fingerprint``)
+    '''
 
-                out.write(message_template.expand(
-                    list_address=args.list_address,
-                    title=args.page_title,
-                    top_level=args.page_link,
-                    web_root=args.web_root,
+    names = {}
+    with OutputWriter(args, 'static-files') as writer:
+        for _, filename, name, data in static_files(args):
+            targets = [filename] if name == filename else [filename, name]
+            for target in targets:
+                with writer.open(path.join(args.output, target)) as out:
+                    out.write(data)
 
-                    template=message_template,
-                    message=message,
-                    next_thread=forward,
-                    previous_thread=back,
+            names[filename] = name
 
-                    author_index=args.author_index,
-                    date_index=args.date_index,
-                    subject_index=args.subject_index,
-                    thread_index=args.thread_index,
-                ))
+        if getattr(args, 'fingerprint', False):
+            with writer.open(path.join(args.output, ASSET_MANIFEST)) as out:
+                out.write(json.dumps(names, sort_keys=True).encode('utf-8'))
 
 
-def run_static(args):
-    'writes static files to the specified output directory'
+def save_manifest(args, previous, pages, key='pages'):
+    '''
+    removes the message pages (or the index pages, given "indices") of the
+    last build (``previous``) which were not built again and writes the
+    digests of the pages
+    '''
+
+    for name in set(previous) - set(pages):
+        remove_output(path.join(args.output,
+                                name + '.html' if key == 'pages' else name))
+
+    filename = path.join(args.output, DEFAULT_MANIFEST)
+    manifest = load_json(filename) or {}
+    manifest[key] = pages
+
+    with open(filename, 'wb') as file:
+        file.write(json.dumps(manifest, sort_keys=True).encode('utf-8'))
+
+
+def save_messages(threads, args, writer, locations=None):
+    '''
+    writes messages.json with an ``OutputWriter`` and splits it into the
+    chunks fetched by the message pages
+
+    Each chunk (``messages/<n>.json``) holds the threads of a
+    ``message_chunks`` chunk. ``messages/index.json`` is the index the pages
+    look messages up in::
+
+        {"chunks": [<first thread of each chunk>, ...],
+         "threads": [[<chunk>, <paging info of the first message>...], ...],
+         "messages": {<message id hash>: [<thread>, <position>], ...}}
+
+    where the paging info is its "from", "message_id", "message_id_hash" and
+    "subject" (the previous and next threads of a message are its thread's
+    neighbours).
+
+    With the ``locations`` of paginated indices (see ``index_pages``) the
+    index also has the filenames of the pages of each index::
+
+        "pages": [[<link>, [<filename>, ...]], ...]
+
+    and the position of a message is followed by the number of its page in
+    each of them.
+    '''
+
+    mbox_index = getattr(args, 'mbox_index', None)
+    load_payload = mbox_index.load_payload if mbox_index else \
+                   lambda message: message
+
+    dump = lambda value: json.dumps(value, ensure_ascii=False,
+                                    default=json_default).encode('utf-8')
+
+    directory = path.join(args.output, MESSAGES_DIRECTORY)
+    if not path.isdir(directory):
+        makedirs(directory)
+
+    # the pages of each index, numbered as they are first seen
+    links = [(link, {}) for link in ('author_index', 'date_index',
+                                     'subject_index', 'thread_index')] \
+            if locations else []
+
+    # written one chunk at a time so deferred payloads are only loaded
+    # while they are encoded
+    chunks, pages, positions = [], [], {}
+    with writer.open(path.join(args.output, 'messages.json')) as out:
+        out.write(b'[')
+        for number, (chunk, _, _) in enumerate(message_chunks(threads)):
+            chunks.append(len(pages))
+
+            encoded = []
+            for top, messages in chunk:
+                for position, message in enumerate(messages):
+                    positions[message.headers.message_id_hash] = \
+                        [len(pages), position] + [
+                            numbers.setdefault(
+                                location(locations, message, link, args),
+                                len(numbers))
+                            for link, numbers in links
+                        ]
+
+                info = paging_info(messages[0])
+                pages.append([number, info['from'], info.message_id,
+                              info.message_id_hash, info.subject])
+
+                encoded.append(dump((top, [load_payload(m)
+                                           for m in messages])))
+
+            if number: out.write(b', ')
+            out.write(b', '.join(encoded))
+
+            filename = path.join(directory, '%d.json' % number)
+            with writer.open(filename) as file:
+                file.write(b'[' + b', '.join(encoded) + b']')
+
+        out.write(b']')
+
+    index = dict(chunks=chunks, threads=pages, messages=positions)
+    if links:
+        index['pages'] = [[link, sorted(numbers, key=numbers.get)]
+                          for link, numbers in links]
+
+    with writer.open(path.join(directory, MESSAGES_INDEX)) as file:
+        file.write(dump(index))
+
+    # the chunks of a larger archive
+    for filename in listdir(directory):
+        match = re.match(r'(\d+)\.json$', filename)
+        if match and int(match.group(1)) >= len(chunks):
+            writer.remove(path.join(directory, filename))
+
+
+def save_state(filename, state):
+    'saves the state of an incremental conversion'
+
+    with open(filename, 'wb') as file:
+        file.write(json.dumps(state, sort_keys=True).encode('utf-8'))
+
+
+def static_files(args):
+    '''
+    yields the key (see ``ASSETS``), filename, name (the fingerprinted
+    ``name.<hash>.ext`` with ``--fingerprint``) and content of each static
+    file
+    '''
 
     PATTERN = re.compile('(["\'])')
     formatters = {'string-data': lambda x: PATTERN.sub(r'\\\1', x)}
 
     R = lambda x: Path(x, pkg_resource=True)
 
-    # partial templates (client side rendering)
-    partials = R('data/templates/partials/')
-    with open(path.join(args.output, 'templates.json'), 'wb') as out:
-        out.write(json.dumps(dict(
-            (name, (partials + name).read(encoding='utf-8'))
-            for name in partials.listdir()
-            if name.endswith('.jst')
-        )).encode('utf-8'))
+    assets = {}
+    for key, filename, resources in ASSETS:
+        # partial templates (client side rendering)
+        if key == 'templates_json':
+            partials = R('data/templates/partials/')
+            data = json.dumps(dict(
+                (name, (partials + name).read(encoding='utf-8'))
+                for name in partials.listdir()
+                if name.endswith('.jst')
+            )).encode('utf-8')
+
+        # message.js.jst expansion (given the names of the other assets)
+        elif key == 'messages_js':
+            template = R(resources[0]).read(encoding='utf-8')
+            data = jsontemplate.expand(template,
+                                       dict(args.__dict__, assets=assets),
+                                       meta='[[]]',
+                                       more_formatters=formatters)
+            data = data.encode('utf-8')
+
+        # everything else is a copy (history.js includes its adapter)
+        else:
+            data = b';\n'.join(R(name).read() for name in resources)
+
+        name = filename
+        if getattr(args, 'fingerprint', False):
+            base, extension = path.splitext(filename)
+            name = '%s.%s%s' % (base, sha1(data).hexdigest()[:FINGERPRINT],
+                                extension)
+
+        assets[key] = name
+        yield key, filename, name, data
+
+
+def stream_template(template, data, out, size=TOKENS_PER_WRITE):
+    '''
+    writes the expansion of a template to ``out`` every ``size`` tokens,
+    ``Fragment`` tokens are expanded in their place
+    '''
 
-    # message.js.jst expansion
-    with open(path.join(args.output, 'messages.js'), 'wb') as out:
-        template = R('data/scripts/messages.js.jst').read(encoding='utf-8')
+    tokens = []
 
-        data = jsontemplate.expand(template, args.__dict__, meta='[[]]',
-                                   more_formatters=formatters).encode('utf-8')
+    def append(token):
+        tokens.append(token)
+        if len(tokens) >= size:
+            out.write(jsontemplate.JoinTokens(tokens))
+            del tokens[:]
 
-        out.write(data)
+    def write(token):
+        if not isinstance(token, Fragment):
+            append(token)
+            return
 
-    # history.js + adapter
-    with open(path.join(args.output, 'history.js'), 'wb') as out:
-        out.write(R('data/scripts/history.js').read())
-        out.write(';\n')
-        out.write(R('data/scripts/history.adapter.jquery.js').read())
+        # the fragments being written, innermost last
+        stack = [iter(token.tokens())]
+        while stack:
+            for token in stack[-1]:
+                if isinstance(token, Fragment):
+                    stack.append(iter(token.tokens()))
+                    break
 
-    # everything else is a straight copy to output directory
-    for type, files in (('scripts',
-                            ['jquery-1.7.2.min.js', 'json-template.js']),
-                        ('styles',
-                            ['messages.css'])):
+                append(token)
+            else:
+                stack.pop()
 
-        for filename in files:
-            with open(path.join(args.output, filename), 'wb') as out:
-                out.write(R('data/%s/%s' % (type, filename)).read())
+    template.execute(data, write)
+    out.write(jsontemplate.JoinTokens(tokens))
+
+
+def template_version(args, templates=None):
+    '''
+    returns the digest of the templates (the message template by default),
+    the partials and the options used to render the pages
+    '''
+
+    digest = sha1()
+    for filename in (templates or [args.message_template]) + \
+                    sorted(args.partials + name for name in
+                           (args.partials.listdir() if args.partials.isdir()
+                            else ())):
+
+        if isinstance(filename, Path):
+            data = filename.read(encoding='utf-8')
+        else:
+            with open(filename, encoding='utf-8') as file:
+                data = file.read()
+
+        digest.update(data.encode('utf-8'))
+
+    options = [getattr(args, key) for key in (
+        'list_address', 'page_title', 'page_link', 'web_root',
+        'author_index', 'date_index', 'subject_index', 'thread_index',
+        'author_title', 'date_title', 'subject_title', 'thread_title',
+        'paginate', 'page_size', 'assets',
+    )]
+    digest.update(json.dumps(options).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def thread_messages(messages, threading='in-reply-to'):
+    '''
+    threads (with the ``threading`` engine, see ``THREADERS``), ties and
+    flattens a sequence of parsed messages
+    '''
+
+    return tie_flatten_threads(THREADERS[threading](list(messages)))
 
 
 convert_parser = ArgumentParser(
     description='Parses local or remote mbox files and saves parsed '
                 'representation in JSON')
 
+convert_parser.add_argument('--dedupe', default=False, action='store_true',
+                            help='Only keep the first message with a given '
+                                 'Message-Id')
+
 convert_parser.add_argument('--gzip', default=False, action='store_true',
                             help='Use gzip to decompress the target file')
 
+convert_parser.add_argument('--header', dest='headers', action='append',
+                            metavar='HEADER',
+                            help='Additional header to keep in the output '
+                                 '(can be repeated, "*" keeps all headers)')
+
+convert_parser.add_argument('--incremental', default=False,
+                            action='store_true',
+                            help='Only parse the messages appended to the '
+                                 'local mbox files since the last run '
+                                 '(requires --output, the state is saved '
+                                 'in OUTPUT%s)' % STATE_SUFFIX)
+
+convert_parser.add_argument('--jobs', '-j', default=1, type=int,
+                            help='Number of processes used to parse a local '
+                                 'mbox file (default: 1)')
+
 convert_parser.add_argument('--output', '-o', default=None,
                             help='Filename to save the output to '
                                  '(default: stdout)')
 
-convert_parser.add_argument('url', help='URL or filename to parse')
+convert_parser.add_argument('--threading', default='in-reply-to',
+                            choices=sorted(THREADERS),
+                            help='Thread messages on their In-Reply-To '
+                                 'header only or on their whole References '
+                                 'header (default: in-reply-to)')
+
+convert_parser.add_argument('--workers', default=4, type=int,
+                            help='Number of inputs fetched and decompressed '
+                                 'at the same time (default: 4)')
+
+convert_parser.add_argument('urls', metavar='url', nargs='+',
+                            help='URL, filename or glob to parse (a URL '
+                                 'ending in "/" or ".html" is read as a '
+                                 'pipermail listing page)')
 
 
 mailarchive_parser = ArgumentParser()
@@ -623,19 +2108,68 @@ message_parent_parser.set_defaults(
     message_template=None
 )
 
-message_parent_parser.add_argument('url',
-                                   help='URL or filename to use as input')
+message_parent_parser.add_argument('urls', metavar='url', nargs='+',
+                                   help='URL, filename or glob to use as '
+                                        'input (a URL ending in "/" or '
+                                        '".html" is read as a pipermail '
+                                        'listing page)')
+
+message_parent_parser.add_argument('--dedupe', default=False,
+                                   action='store_true',
+                                   help='Only keep the first message with a '
+                                        'given Message-Id')
 
 message_parent_parser.add_argument('--gzip', default=False,
                                    action='store_true',
                                    help='Use gzip to decompress the target '
                                         'file')
 
+message_parent_parser.add_argument('--header', dest='headers',
+                                   action='append', metavar='HEADER',
+                                   help='Additional header to keep in the '
+                                        'messages (can be repeated, "*" '
+                                        'keeps all headers)')
+
+message_parent_parser.add_argument('--index', default=False,
+                                   action='store_true',
+                                   help='Index the target mbox file (saved '
+                                        'next to it) and only load message '
+                                        'bodies when they are rendered')
+
+message_parent_parser.add_argument('--jobs', '-j', default=1, type=int,
+                                   help='Number of processes used to parse '
+                                        'a local mbox file and to build the '
+                                        'pages (default: 1)')
+
 message_parent_parser.add_argument('--json', default=False,
                                    action='store_true',
                                    help='Treat the target file as a parsed '
                                         'JSON instance')
 
+message_parent_parser.add_argument('--threading', default='in-reply-to',
+                                   choices=sorted(THREADERS),
+                                   help='Thread messages on their '
+                                        'In-Reply-To header only or on their '
+                                        'whole References header (default: '
+                                        'in-reply-to)')
+
+message_parent_parser.add_argument('--workers', default=4, type=int,
+                                   help='Number of inputs fetched and '
+                                        'decompressed at the same time '
+                                        '(default: 4)')
+
+message_parent_parser.add_argument('--paginate', action='store_true',
+                                   help='Split the indices into pages: the '
+                                        'date and thread indices by month, '
+                                        'the subject and author indices by '
+                                        'first letter')
+
+message_parent_parser.add_argument('--page-size', metavar='N', default=0,
+                                   type=int,
+                                   help='With --paginate, split the indices '
+                                        'into pages of about N messages '
+                                        'instead')
+
 message_parent_parser.add_argument('--partials', metavar='PARTIALS_DIR',
                                    default=None,
                                    help='Partials directory to use'
@@ -673,10 +2207,33 @@ message_parser.add_argument('--message-template', '--message',
 
 message_parser.set_defaults(action=run_messages)
 
+for parser in (build_parser, index_parser, message_parser):
+    parser.add_argument('--force', default=False, action='store_true',
+                        help='Write every page (by default only the pages '
+                             'whose content changed since the last build '
+                             'are written)')
+
+
 static_parser = mailarchive_subparser.add_parser('static-files')
 
 static_parser.set_defaults(action=run_static)
 
 
+for parser in (build_parser, index_parser, message_parser, static_parser):
+    parser.add_argument('--fingerprint', default=False, action='store_true',
+                        help='Also write the static files as '
+                             '"name.<hash>.ext" (listed in %s) and refer to '
+                             'those names, so they can be cached forever'
+                                % ASSET_MANIFEST)
+
+    parser.add_argument('--precompress', metavar='FORMATS', default=None,
+                        type=precompress_formats,
+                        help='Also write compressed copies of the files '
+                             '(comma separated: "gzip" writes ".gz" files '
+                             'and "br" ".br" files, which needs the brotli '
+                             'package), only files whose content changed '
+                             'are compressed again')
+
+
 if __name__ == '__main__':
     run_mailarchive()
@@ -12,6 +12,7 @@ setup(
     packages = find_packages(),
 
     install_requires = ['PyYAML', 'jsontemplate', 'python-dateutil'],
+    extras_require = {'brotli': ['brotli']},
 
     author = 'Terence Honles',
     author_email = 'terence@honles.com',
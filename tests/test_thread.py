@@ -0,0 +1,81 @@
+# vim: set fileencoding=utf-8 :
+
+from __future__ import unicode_literals
+
+import os
+import unittest
+
+from mailarchive.parse import parse_mbox
+from mailarchive.thread import reference_threads
+
+
+CORPUS = os.path.join(os.path.dirname(__file__), 'threads.mbox')
+
+
+def _ids(thread):
+    'yields the message ids of a thread shape (see ``shape``)'
+
+    id, children = thread
+    yield id
+    for child in children:
+        for id in _ids(child):
+            yield id
+
+
+def shape(thread):
+    'returns a thread as nested (message id, replies) pairs'
+
+    return (thread.message.headers.message_id,
+            [shape(child) for child in thread.children])
+
+
+class ReferenceThreadsTest(unittest.TestCase):
+    'the threads of threads.mbox built from the References headers'
+
+    def setUp(self):
+        messages = list(parse_mbox(CORPUS))
+        self.threads = [shape(t) for t in reference_threads(messages)]
+
+    def test_loop(self):
+        'the earliest message of a loop is the reply'
+
+        self.assertIn(('<h@example.com>', [('<g@example.com>', [])]),
+                      self.threads)
+
+    def test_mangled_in_reply_to(self):
+        'a mangled In-Reply-To is placed by the References header'
+
+        root = dict(self.threads)['<a@example.com>']
+        self.assertIn(('<b@example.com>', [('<c@example.com>', [])]), root)
+
+    def test_missing_parent(self):
+        'a missing reply is replaced by its replies'
+
+        root = dict(self.threads)['<a@example.com>']
+        self.assertIn(('<d@example.com>', []), root)
+
+    def test_missing_root(self):
+        'a missing root is kept as a stub of its replies'
+
+        self.assertEqual(self.threads[0], ('<gone@example.com>', [
+            ('<e@example.com>', []),
+            ('<f@example.com>', []),
+        ]))
+
+    def test_reply_to_itself(self):
+        'a message referencing itself is a thread of its own'
+
+        self.assertIn(('<i@example.com>', []), self.threads)
+
+    def test_threads(self):
+        'every message is in a single thread'
+
+        self.assertEqual(len(self.threads), 4)
+        self.assertEqual(sorted(id for thread in self.threads
+                                for id in _ids(thread)),
+                         sorted('<%s@example.com>' % id for id in
+                                ['gone'] + list('abcdefghi')))
+
+
+if __name__ == '__main__':
+    unittest.main()